@@ -1,174 +1,1078 @@
 #!/usr/bin/env python
 """Kafka-Reporting API interaction."""
 
-import json
+import email.utils
 import logging
+import os
 import platform
+import random
+import threading
 import time
 import uuid
 
+from functools import partial
 from multiprocessing.pool import ThreadPool
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import arrow
 import requests
 
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connection import (HTTPConnection,
+                                                  HTTPSConnection)
+from requests.packages.urllib3.connectionpool import (HTTPConnectionPool,
+                                                      HTTPSConnectionPool)
+
+from .. import serializer
+from ..cachefile import cache_path
+from ..pipeline import Interleave, Prefetch, merge
+
 REPORTING_RETRY_LIMIT = 10
+
+# Retry schedule: "full jitter" exponential backoff, uniformly random up to
+# RETRY_BASE * 2 ** attempt seconds but never more than RETRY_CAP.
+RETRY_BASE = 2.0
+RETRY_CAP = 60.0
+
+# Retry budget: retries beyond RETRY_BUDGET_MINIMUM, as a fraction of all
+# requests, above which retries wait close to RETRY_CAP, so a struggling
+# server is not swamped.
+# Calls and retries are counted with a half-life of RETRY_BUDGET_HALF_LIFE
+# seconds, so a long healthy run does not bank retries for an outage.
+RETRY_BUDGET = 0.2
+RETRY_BUDGET_MINIMUM = 10
+RETRY_BUDGET_HALF_LIFE = 60.0
+
+# Circuit breaker: after this many consecutive failures, calls and retries
+# wait BREAKER_COOLDOWN seconds before trying the server again.
+BREAKER_THRESHOLD = 20
+BREAKER_COOLDOWN = 30.0
 SESSION = str(uuid.uuid4())
 
+# Connection pool defaults: number of hosts to keep pools for, connections
+# kept alive per host, and whether to block rather than exceed that limit.
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+POOL_BLOCK = False
+
+# Worker threads shared by every concurrent API call in the process; by
+# default one per keep-alive connection.
+EXECUTOR_THREADS = POOL_MAXSIZE
+
+# Limits on the messages packed into one POST by API.put_many.
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+MAX_BATCH_MESSAGES = 500
+
+# Batches fetched ahead of the consumer by API.iter_batches.
+PREFETCH_DEPTH = 4
+
+# Seconds between attempts to take a host slot while all are held.
+HOST_SLOT_POLL = 0.05
+
+
+class ConnectionStats:
+    """Thread-safe counters for requests sent and connections opened."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def request(self):
+        """Count one HTTP request."""
+        with self.lock:
+            self.requests += 1
+
+    def connection(self):
+        """Count one newly established TCP connection."""
+        with self.lock:
+            self.connections += 1
+
+    def snapshot(self):
+        """Return the counters, splitting requests into new and reused."""
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "new": self.connections,
+                "reused": max(self.requests - self.connections, 0)
+            }
+
+
+STATS = ConnectionStats()
+
+
+class _CountingHTTPConnection(HTTPConnection):
+    """HTTP connection which records every (re)connect in STATS."""
+
+    def connect(self):
+        STATS.connection()
+        return HTTPConnection.connect(self)
+
+
+class _CountingHTTPSConnection(HTTPSConnection):
+    """HTTPS connection which records every (re)connect in STATS."""
+
+    def connect(self):
+        STATS.connection()
+        return HTTPSConnection.connect(self)
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    """HTTP connection pool using counted connections."""
+
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    """HTTPS connection pool using counted connections."""
+
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _PoolAdapter(HTTPAdapter):
+    """Transport adapter whose connections are counted in STATS."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool
+        }
+
+
+class Pool:
+    """A keep-alive HTTP session shared by every API instance.
+
+    requests.Session is safe to share between threads for plain requests
+    like ours (no cookies); urllib3 hands each thread its own connection
+    from the per-host pool.
+    """
+
+    def __init__(self, connections=POOL_CONNECTIONS, maxsize=POOL_MAXSIZE,
+                 block=POOL_BLOCK, keep_alive=True):
+        self.session = requests.Session()
+        adapter = _PoolAdapter(pool_connections=connections,
+                               pool_maxsize=maxsize,
+                               pool_block=block)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        if not keep_alive:
+            self.session.headers["Connection"] = "close"
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the pooled session."""
+        STATS.request()
+        return self.session.request(method, url, **kwargs)
+
+
+_POOL = {"pool": None}
+_POOL_LOCK = threading.Lock()
+
+
+def configure_pool(connections=POOL_CONNECTIONS, maxsize=POOL_MAXSIZE,
+                   block=POOL_BLOCK, keep_alive=True):
+    """(Re)create the process-wide connection pool with the given limits."""
+    with _POOL_LOCK:
+        _POOL["pool"] = Pool(connections, maxsize, block, keep_alive)
+        return _POOL["pool"]
+
+
+def shared_pool():
+    """Return the process-wide connection pool, creating it if needed."""
+    with _POOL_LOCK:
+        if _POOL["pool"] is None:
+            _POOL["pool"] = Pool()
+        return _POOL["pool"]
+
+
+def connection_stats():
+    """Return request/connection counters for this process."""
+    return STATS.snapshot()
+
+
+class RetryPolicy:
+    """Retries with jittered, capped backoff, shared by every API call.
+
+    A call is retried on connection errors, 429 and 5xx responses, up to
+    `limit` attempts; Retry-After is honoured (up to the cap). All callers
+    share one retry budget and one circuit breaker, so parallel workers
+    back off together instead of retrying in lockstep: while the breaker
+    is open, calls and retries wait until it closes (plus jitter), and
+    once the budget is spent retries wait between half the cap and the
+    cap. Neither fails a call by itself; only running out of attempts
+    does, so long-running commands ride out outages of a few minutes
+    (with the defaults, a call gives up after at most about nine).
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(self, limit=REPORTING_RETRY_LIMIT, base=RETRY_BASE,
+                 cap=RETRY_CAP, budget=RETRY_BUDGET,
+                 budget_minimum=RETRY_BUDGET_MINIMUM,
+                 threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN,
+                 half_life=RETRY_BUDGET_HALF_LIFE):
+        self.limit = limit
+        self.base = base
+        self.cap = cap
+        self.budget = budget
+        self.budget_minimum = budget_minimum
+        self.half_life = half_life
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.open_until = 0
+        self.metrics = {"calls": 0, "retries": 0, "retry_seconds": 0.0,
+                        "breaker_opened": 0, "breaker_waits": 0,
+                        "budget_waits": 0, "gave_up": 0}
+        # Decaying counts of recent calls and retries, for the budget.
+        self.recent = {"calls": 0.0, "retries": 0.0, "updated": time.time()}
+
+    def snapshot(self):
+        """Return the retry counters."""
+        with self.lock:
+            return dict(self.metrics)
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number `attempt` (from 0)."""
+        if retry_after is not None:
+            return min(max(retry_after, 0), self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    @staticmethod
+    def retry_after(response):
+        """Seconds asked for by a Retry-After header, if any."""
+        # (Not `if response`: a response is falsy for any error status.)
+        value = (response.headers.get("Retry-After")
+                 if response is not None else None)
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            date = email.utils.parsedate_tz(value)
+            if date is None:
+                return None
+            return email.utils.mktime_tz(date) - time.time()
+
+    @staticmethod
+    def retryable(response):
+        """Whether a response is worth retrying."""
+        return response.status_code == 429 or response.status_code >= 500
+
+    def _count(self, name):
+        """Add one to a metric and its decaying count; hold the lock."""
+        now = time.time()
+        decay = 0.5 ** ((now - self.recent["updated"]) / self.half_life)
+        self.recent["calls"] *= decay
+        self.recent["retries"] *= decay
+        self.recent["updated"] = now
+        self.recent[name] += 1
+        self.metrics[name] += 1
+
+    def _admit(self):
+        """Count a call, waiting for the breaker to close if it is open."""
+        with self.lock:
+            self._count("calls")
+            wait = self.open_until - time.time()
+            if wait <= 0:
+                return
+            wait += random.uniform(0, self.base)
+            self.metrics["breaker_waits"] += 1
+            self.metrics["retry_seconds"] += wait
+        time.sleep(wait)
+
+    def _succeeded(self):
+        """Record a success, closing the breaker."""
+        with self.lock:
+            self.failures = 0
+
+    def _failed(self, attempt):
+        """Record a failure; return whether another attempt is allowed."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold and \
+                    time.time() >= self.open_until:
+                self.open_until = time.time() + self.cooldown
+                self.metrics["breaker_opened"] += 1
+                logging.error("circuit open for %is after %i failures",
+                              self.cooldown, self.failures)
+
+            if attempt + 1 >= self.limit:
+                self.metrics["gave_up"] += 1
+                return False
+            return True
+
+    def _backoff(self, attempt, retry_after):
+        """Seconds to wait before retry number `attempt`, counting it.
+
+        The usual delay is lengthened while the breaker is open (until it
+        closes) and while the retry budget is spent (to near the cap).
+        """
+        delay = self.delay(attempt, retry_after)
+        with self.lock:
+            now = time.time()
+            if now < self.open_until:
+                delay = max(delay, self.open_until - now +
+                            random.uniform(0, self.base))
+                self.metrics["breaker_waits"] += 1
+            elif self.recent["retries"] >= self.budget_minimum + \
+                    self.budget * self.recent["calls"]:
+                delay = max(delay, random.uniform(self.cap / 2, self.cap))
+                self.metrics["budget_waits"] += 1
+            self._count("retries")
+            self.metrics["retry_seconds"] += delay
+        return delay
+
+    def call(self, send):
+        """Return send()'s response, retrying as the policy allows.
+
+        Responses which are not retryable (including errors such as 4xx)
+        are returned for the caller to handle. Raises IOError when giving
+        up after `limit` attempts.
+        """
+        self._admit()
+        attempt = 0
+        while True:
+            response = None
+            try:
+                response = send()
+                if not self.retryable(response):
+                    self._succeeded()
+                    return response
+                failure = "http error %i" % response.status_code
+            except requests.RequestException as exception:
+                failure = str(exception)
+
+            if not self._failed(attempt):
+                raise IOError("reached retry limit: giving up (%s)" %
+                              failure)
+
+            delay = self._backoff(attempt, self.retry_after(response))
+            logging.warning("%s; will retry in %.1fs (#%i)", failure, delay,
+                            attempt + 1)
+            time.sleep(delay)
+            attempt += 1
+
+
+_RETRY = {"policy": None}
+_RETRY_LOCK = threading.Lock()
+
+
+def configure_retry(**kwargs):
+    """(Re)create the process-wide retry policy (see RetryPolicy)."""
+    with _RETRY_LOCK:
+        _RETRY["policy"] = RetryPolicy(**kwargs)
+        return _RETRY["policy"]
+
+
+def shared_retry():
+    """Return the process-wide retry policy, creating it if needed."""
+    with _RETRY_LOCK:
+        if _RETRY["policy"] is None:
+            _RETRY["policy"] = RetryPolicy()
+        return _RETRY["policy"]
+
+
+def retry_stats():
+    """Return retry counters for this process."""
+    return shared_retry().snapshot()
+
+
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens a second, up to `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else max(self.rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Take one token, waiting for it if need be."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def default_slot_dir(server):
+    """Per-server directory of host slot lock files under ~/.cache/ersa-kr."""
+    return cache_path("slots", server, "")
+
+
+class HostSlots:
+    """In-flight request slots shared by every process on the host.
+
+    Each slot is a lock file in `directory`, held with flock(2) for the
+    duration of a request; the kernel releases the locks of a process which
+    dies. Processes sharing a budget must use the same directory and number
+    of slots.
+    """
+
+    def __init__(self, directory, slots):
+        if fcntl is None:
+            raise ValueError("host slots need fcntl, which is unavailable")
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        self.handles = [open(os.path.join(directory, "%i.lock" % index), "a")
+                        for index in range(slots)]
+        # A lock is held per open file, so threads must not share a slot.
+        self.lock = threading.Lock()
+        self.available = set(range(slots))
+
+    def _take(self, index):
+        """Try to lock one slot not in use by this process."""
+        with self.lock:
+            if index not in self.available:
+                return False
+            self.available.discard(index)
+        try:
+            fcntl.flock(self.handles[index], fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except (IOError, OSError):
+            with self.lock:
+                self.available.add(index)
+            return False
+
+    def acquire(self):
+        """Take a slot, waiting for one if need be; returns its index."""
+        while True:
+            with self.lock:
+                candidates = list(self.available)
+            random.shuffle(candidates)
+            for index in candidates:
+                if self._take(index):
+                    return index
+            time.sleep(HOST_SLOT_POLL)
+
+    def release(self, index):
+        """Give back a slot taken by acquire."""
+        fcntl.flock(self.handles[index], fcntl.LOCK_UN)
+        with self.lock:
+            self.available.add(index)
+
+
+class Governor:
+    """Limits on the requests sent to one server.
+
+    `rate` (requests per second, with bursts of up to `burst`) is enforced
+    by a token bucket, `in_flight` caps concurrent requests within this
+    process, and `host_slots` concurrent requests across every process on
+    the host using the same `slot_dir`. Any of them may be None (no limit).
+    """
+
+    def __init__(self, rate=None, burst=None, in_flight=None,
+                 host_slots=None, slot_dir=None):
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.slots = (threading.BoundedSemaphore(in_flight) if in_flight
+                      else None)
+        self.host = HostSlots(slot_dir, host_slots) if host_slots else None
+        self.lock = threading.Lock()
+        self.metrics = {"requests": 0, "rate_seconds": 0.0,
+                        "slot_seconds": 0.0, "host_seconds": 0.0}
+
+    def _wait(self, metric, acquire):
+        """Call acquire, adding the time it took to a metric."""
+        start = time.time()
+        result = acquire()
+        with self.lock:
+            self.metrics[metric] += time.time() - start
+        return result
+
+    def call(self, send):
+        """Return send() once the limits allow another request."""
+        with self.lock:
+            self.metrics["requests"] += 1
+        if self.slots is not None:
+            self._wait("slot_seconds", self.slots.acquire)
+        try:
+            host_slot = (self._wait("host_seconds", self.host.acquire)
+                         if self.host is not None else None)
+            try:
+                if self.bucket is not None:
+                    self._wait("rate_seconds", self.bucket.acquire)
+                return send()
+            finally:
+                if host_slot is not None:
+                    self.host.release(host_slot)
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    def snapshot(self):
+        """Return the request count and seconds spent waiting on limits."""
+        with self.lock:
+            return dict(self.metrics)
+
+
+# Governor settings by server; those under None apply to other servers.
+_GOVERNORS = {"settings": {None: {}}, "governors": {}}
+_GOVERNORS_LOCK = threading.Lock()
+
+
+def configure_governor(server=None, **kwargs):
+    """Set the request limits (see Governor) for a server, or by default.
+
+    Without a `slot_dir`, each server's host slots live in a directory of
+    their own (see default_slot_dir).
+    """
+    if kwargs.get("host_slots") and fcntl is None:
+        raise ValueError("host slots need fcntl, which is unavailable")
+    with _GOVERNORS_LOCK:
+        _GOVERNORS["settings"][server] = kwargs
+        if server is None:
+            _GOVERNORS["governors"] = {}
+        else:
+            _GOVERNORS["governors"].pop(server, None)
+
+
+def shared_governor(server):
+    """Return the process-wide governor for a server, creating it if needed."""
+    with _GOVERNORS_LOCK:
+        governor = _GOVERNORS["governors"].get(server)
+        if governor is None:
+            settings = dict(_GOVERNORS["settings"].get(
+                server, _GOVERNORS["settings"][None]))
+            if settings.get("host_slots") and not settings.get("slot_dir"):
+                settings["slot_dir"] = default_slot_dir(server or "default")
+            governor = Governor(**settings)
+            _GOVERNORS["governors"][server] = governor
+        return governor
+
+
+def governor_stats():
+    """Return the governor counters of this process, summed over servers."""
+    with _GOVERNORS_LOCK:
+        governors = list(_GOVERNORS["governors"].values())
+    totals = {"requests": 0, "rate_seconds": 0.0, "slot_seconds": 0.0,
+              "host_seconds": 0.0}
+    for governor in governors:
+        for key, value in governor.snapshot().items():
+            totals[key] += value
+    return totals
+
+
+class Executor:
+    """Worker threads shared by the concurrent API calls of a process.
+
+    Subcommands draw on this one bounded pool rather than creating
+    ThreadPools of their own: each call limits its own in-flight tasks,
+    and the pool size bounds the process as a whole. Tasks must not wait
+    on other tasks of the same executor.
+    """
+
+    def __init__(self, threads=EXECUTOR_THREADS):
+        self.threads = threads
+        self.pool = ThreadPool(threads)
+
+    def imap_unordered(self, function, items, limit=None):
+        """Yield function(item) for each item, as results complete.
+
+        Items are consumed lazily, with at most `limit` (default: the pool
+        size) in flight. The first exception raised is re-raised here.
+        """
+        limit = limit if limit else self.threads
+        done = queue.Queue()
+
+        def run(item):
+            """Run one task, reporting its outcome to the caller."""
+            try:
+                done.put((True, function(item)))
+            except Exception as exception:  # pylint: disable=broad-except
+                done.put((False, exception))
+
+        def collect():
+            """Wait for one outcome."""
+            succeeded, value = done.get()
+            if not succeeded:
+                raise value
+            return value
+
+        pending = 0
+        for item in items:
+            if pending >= limit:
+                yield collect()
+                pending -= 1
+            self.pool.apply_async(run, (item,))
+            pending += 1
+        while pending > 0:
+            yield collect()
+            pending -= 1
+
+    def submit(self, function, *args):
+        """Run function(*args) on the pool; returns its AsyncResult."""
+        return self.pool.apply_async(function, args)
+
+    def map(self, function, items, limit=None):
+        """Return [function(item) for item in items], run concurrently."""
+        indexed = self.imap_unordered(
+            lambda pair: (pair[0], function(pair[1])), enumerate(items),
+            limit)
+        return [value for _, value in sorted(indexed, key=lambda p: p[0])]
+
+
+_EXECUTOR = {"executor": None}
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def configure_executor(threads=EXECUTOR_THREADS):
+    """(Re)create the process-wide executor with the given thread count."""
+    with _EXECUTOR_LOCK:
+        _EXECUTOR["executor"] = Executor(threads)
+        return _EXECUTOR["executor"]
+
+
+def shared_executor():
+    """Return the process-wide executor, creating it if needed."""
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR["executor"] is None:
+            _EXECUTOR["executor"] = Executor()
+        return _EXECUTOR["executor"]
+
+
+def parse_time(value):
+    """Parse an ISO 8601 time into a message timestamp (milliseconds)."""
+    return int(arrow.get(value).float_timestamp * 1000)
+
+
+def summarise(partitions):
+    """Combine per-partition metadata into topic metadata."""
+    metadata = {
+        "partitions": partitions,
+        "messages": 0,
+        "earliest_timestamp": None,
+        "latest_timestamp": None,
+        "earliest_offsets": ["-" for _ in range(len(partitions))],
+        "latest_offsets": ["-" for _ in range(len(partitions))]
+    }
+    for partition in partitions:
+        partition_id = partition["partition"]
+        partition_size = partition["latestOffset"] - partition[
+            "earliestOffset"]
+        metadata["messages"] += partition_size
+        if partition_size > 0:
+            metadata["earliest_offsets"][partition_id] = partition[
+                "earliestOffset"]
+            metadata["latest_offsets"][partition_id] = partition[
+                "latestOffset"]
+
+            when = partition["earliest_timestamp"]
+            if when and (not metadata["earliest_timestamp"] or
+                         when < metadata["earliest_timestamp"]):
+                metadata["earliest_timestamp"] = when
+
+            when = partition["latest_timestamp"]
+            if when and (not metadata["latest_timestamp"] or
+                         when > metadata["latest_timestamp"]):
+                metadata["latest_timestamp"] = when
+    return metadata
+
 
 class API:
     """Fetch messages from the kafka-reporting API."""
 
-    def __init__(self, server, username, token, https_verify=True):
+    def __init__(self, server, username, token, https_verify=True,
+                 pool=None, retry=None, governor=None):
         self.server = server
         self.username = username
         self.token = token
         self.https_verify = https_verify
+        self.pool = pool if pool else shared_pool()
+        self.retry = retry if retry else shared_retry()
+        self.governor = governor if governor else shared_governor(server)
+
+    def _request(self, method, url, **kwargs):
+        """Send an authenticated request through the connection pool.
+
+        Each attempt waits for the server's governor; time spent backing
+        off between retries holds none of its slots.
+        """
+        return self.governor.call(partial(self.pool.request, method, url,
+                                          auth=(self.username, self.token),
+                                          verify=self.https_verify,
+                                          **kwargs))
+
+    def _timestamp(self, topic, partition, offset):
+        """Timestamp of the message at offset, or None if there is none."""
+        data = self.get(topic, partition, offset)[0]
+        if data:
+            return arrow.get(data[0]["timestamp"] / 1000)
+        return None
 
-    def _parse_partitions(self, topic, partitions):
-        """Parse partition metadata."""
+    def _fetch_partition(self, topic, partition, timestamps=True,
+                         cached=None):
+        """Fetch metadata for one (partition_id, offsets) pair.
+
+        Timestamps are reused from `cached` (a previous result for the same
+        partition) when the corresponding offset has not moved.
+        """
+        partition_id, partition_metadata = partition
         metadata = {
-            "messages": 0,
+            "partition": int(partition_id),
+            "earliestOffset": partition_metadata["earliestOffset"],
+            "latestOffset": partition_metadata["latestOffset"],
             "earliest_timestamp": None,
-            "latest_timestamp": None,
-            "earliest_offsets": ["-" for _ in range(len(partitions))],
-            "latest_offsets": ["-" for _ in range(len(partitions))]
+            "latest_timestamp": None
         }
-        for partition_id, partition_metadata in partitions.items():
-            partition_id = int(partition_id)
-            partition_size = partition_metadata[
-                "latestOffset"
-            ] - partition_metadata["earliestOffset"]
-            metadata["messages"] += partition_size
-            if partition_size > 0:
-                metadata["earliest_offsets"][
-                    partition_id
-                ] = partition_metadata["earliestOffset"]
-
-                earliest = self.get(
-                    topic, int(partition_id),
-                    partition_metadata["earliestOffset"])[0]
-                if earliest:
-                    message = earliest[0]
-                    when = arrow.get(message["timestamp"] / 1000)
-
-                    if not metadata["earliest_timestamp"]:
-                        metadata["earliest_timestamp"] = when
-                    else:
-                        metadata["earliest_timestamp"] = min(
-                            metadata["earliest_timestamp"], when)
-
-                metadata["latest_offsets"][partition_id] = partition_metadata[
-                    "latestOffset"
-                ]
-
-                latest = self.get(topic, int(partition_id), -1)[0]
-                if latest:
-                    message = latest[0]
-                    when = arrow.get(message["timestamp"] / 1000)
-
-                    if not metadata["latest_timestamp"]:
-                        metadata["latest_timestamp"] = when
-                    else:
-                        metadata["latest_timestamp"] = max(
-                            metadata["latest_timestamp"], when)
+        if not timestamps or metadata["latestOffset"] <= metadata[
+                "earliestOffset"]:
+            return metadata
+
+        previous = cached.get(metadata["partition"]) if cached else None
+        if previous and previous["latestOffset"] <= previous[
+                "earliestOffset"]:
+            previous = None
+
+        if previous and previous["earliestOffset"] == metadata[
+                "earliestOffset"]:
+            metadata["earliest_timestamp"] = previous["earliest_timestamp"]
+        else:
+            metadata["earliest_timestamp"] = self._timestamp(
+                topic, metadata["partition"], metadata["earliestOffset"])
+
+        if previous and previous["latestOffset"] == metadata["latestOffset"]:
+            metadata["latest_timestamp"] = previous["latest_timestamp"]
+        else:
+            metadata["latest_timestamp"] = self._timestamp(
+                topic, metadata["partition"], -1)
         return metadata
 
-    def _fetch_topic_metadata(self, topic):
-        """Fetch general information about topic."""
+    def topics(self):
+        """Return the names of all topics."""
+        list_url = "https://%s/v1/topic" % self.server
+        list_response = self.retry.call(partial(self._request, "GET",
+                                                list_url))
+        if list_response.status_code != 200:
+            raise IOError(
+                "topic list failure: HTTP %i" % list_response.status_code)
+        return list_response.json()["topics"]
+
+    def partitions(self, topic):
+        """Return raw partition metadata (offsets) keyed by partition id."""
         topic_url = "https://%s/v1/topic/%s" % (self.server, topic)
-        topic_response = requests.get(topic_url,
-                                      auth=(self.username, self.token),
-                                      verify=self.https_verify)
+        topic_response = self.retry.call(partial(self._request, "GET",
+                                                 topic_url))
         if topic_response.status_code != 200:
             raise IOError("topic retrieval failure (%s): HTTP %i" %
                           (topic, topic_response.status_code))
-        partitions = topic_response.json()["partition"]
-        return self._parse_partitions(topic, partitions)
+        return topic_response.json()["partition"]
 
-    def list(self, threads=1):
-        """Return topic metadata."""
-        list_url = "https://%s/v1/topic" % self.server
-        list_response = requests.get(list_url,
-                                     auth=(self.username, self.token),
-                                     verify=self.https_verify)
-        if list_response.status_code != 200:
-            raise IOError(
-                "topic list failure: HTTP %i" % list_response.status_code)
-        topics = {}
-        topic_names = list_response.json()["topics"]
-        topic_metadata = ThreadPool(threads).map(self._fetch_topic_metadata,
-                                                 topic_names)
-        for name, metadata in zip(topic_names, topic_metadata):
-            topics[name] = metadata
+    def iter_list(self, threads=None, timestamps=True, topic_names=None,
+                  cache=None):
+        """Yield (topic, metadata) pairs as each topic completes.
 
-        return topics
+        Partition offsets are fetched for every topic, then partitions are
+        fetched, on the shared executor with at most `threads` (default:
+        the executor size) requests in flight. Without timestamps only
+        offsets are fetched (one request per topic).
 
-    def get(self, topic, partition, offset):
-        """Perform one fetch operation from the given offset."""
+        `cache` maps topic -> partition id -> the "partitions" entries of
+        earlier metadata; timestamps of partitions whose offsets have not
+        moved are taken from it instead of being fetched again.
+        """
+        if topic_names is None:
+            topic_names = self.topics()
+        executor = shared_executor()
+
+        offsets = dict(executor.imap_unordered(
+            lambda topic: (topic, self.partitions(topic)), topic_names,
+            threads))
+
+        def fetch(job):
+            """Fetch one partition of one topic."""
+            topic, partition = job
+            cached = cache.get(topic) if cache else None
+            return topic, self._fetch_partition(topic, partition, timestamps,
+                                                cached)
+
+        fetched = dict((topic, []) for topic in topic_names)
+        jobs = []
+        for topic in topic_names:
+            if len(offsets[topic]) == 0:
+                yield topic, summarise([])
+            jobs.extend((topic, partition)
+                        for partition in offsets[topic].items())
+
+        for topic, metadata in executor.imap_unordered(fetch, jobs, threads):
+            fetched[topic].append(metadata)
+            if len(fetched[topic]) == len(offsets[topic]):
+                yield topic, summarise(sorted(fetched[topic],
+                                              key=lambda p: p["partition"]))
+
+    def list(self, threads=None, timestamps=True):
+        """Return topic metadata."""
+        return dict(self.iter_list(threads, timestamps))
+
+    def _fetch(self, topic, partition, offset):
+        """Perform one fetch operation; return the raw message entries."""
         url = "https://%s/v1/topic/%s/%d/%d" % (
             self.server, topic, partition, offset)
 
-        retry = 0
-        while retry < REPORTING_RETRY_LIMIT:
-            response = requests.get(
-                url,
-                auth=(self.username, self.token),
-                verify=self.https_verify)
-            if response.status_code == 200:
-                data = response.json()
-                break
-            elif response.status_code >= 400 and response.status_code < 500:
-                raise RuntimeError("http error %i" % response.status_code)
-            else:
-                logging.warning("http error %i; will retry (#%i)",
-                                response.status_code, retry + 1)
-                time.sleep(2 * 2 ** retry)
-                retry += 1
+        response = self.retry.call(partial(self._request, "GET", url))
+        if response.status_code != 200:
+            raise RuntimeError("http error %i" % response.status_code)
 
-        if retry == REPORTING_RETRY_LIMIT:
-            raise IOError("reached retry limit: giving up")
+        return response.json()["messages"]
 
-        if len(data["messages"]) > 0:
-            result = [entry["message"] for entry in data["messages"]]
-            next_offset = data["messages"][-1]["next_offset"]
+    def get(self, topic, partition, offset):
+        """Perform one fetch operation from the given offset."""
+        entries = self._fetch(topic, partition, offset)
+
+        if len(entries) > 0:
+            result = [entry["message"] for entry in entries]
+            next_offset = entries[-1]["next_offset"]
             return result, next_offset
         else:
             return None, None
 
-    def put(self, topic, schema, data):
-        """Post a single message to the API."""
+    def _iter_fetches(self, topic, partition, start, end):
+        """Yield (messages, next_offset) batches from start to end."""
+        offset = start
+        while end is None or offset < end:
+            entries = self._fetch(topic, partition, offset)
+            if end is not None:
+                entries = [entry for entry in entries
+                           if entry["next_offset"] <= end]
+            if len(entries) == 0:
+                return
+            offset = entries[-1]["next_offset"]
+            yield [entry["message"] for entry in entries], offset
 
-        url = "https://%s/v1/topic/%s" % (self.server, topic)
+    def iter_batches(self, topic, partition, start=0, end=None,
+                     prefetch=PREFETCH_DEPTH):
+        """Yield (messages, next_offset) batches from start up to end.
+
+        `end` is exclusive; without it, batches are fetched up to the
+        latest offset. Up to `prefetch` batches are fetched by a background
+        thread ahead of the caller (none if `prefetch` is 0).
+        """
+        batches = self._iter_fetches(topic, partition, start, end)
+        if prefetch < 1:
+            for batch in batches:
+                yield batch
+            return
+
+        batches = Prefetch(batches, prefetch)
+        try:
+            for batch in batches:
+                yield batch
+        finally:
+            batches.close()
+
+    def iter_range(self, topic, partition, start=0, end=None,
+                   prefetch=PREFETCH_DEPTH):
+        """Yield the messages from start up to end, lazily.
+
+        See iter_batches; messages are fetched in batches, but only the
+        batches being consumed are held in memory.
+        """
+        return _flatten(self.iter_batches(topic, partition, start, end,
+                                          prefetch))
+
+    def ranges(self, topic):
+        """Return {partition: (earliest offset, latest offset)} for topic.
+
+        The latest offset is exclusive: the offset of the next message.
+        """
+        return dict((int(partition_id), (offsets["earliestOffset"],
+                                         offsets["latestOffset"]))
+                    for partition_id, offsets in
+                    self.partitions(topic).items())
+
+    def iter_topic(self, topic, ranges=None, ordered=False,
+                   prefetch=PREFETCH_DEPTH):
+        """Yield the messages of several partitions of topic, lazily.
+
+        `ranges` maps partition -> (start, end) as for iter_range; by
+        default it is every partition's current range (see ranges()).
+        Partitions are fetched concurrently, each by its own thread up to
+        `prefetch` batches ahead.
+
+        Messages are yielded as they arrive or, if `ordered`, merged by
+        timestamp: each partition is in timestamp order, so the merged
+        stream is too, and only the prefetched batches of each partition
+        are held in memory.
+        """
+        if ranges is None:
+            ranges = self.ranges(topic)
+        fetches = [self._iter_fetches(topic, partition, start, end)
+                   for partition, (start, end) in sorted(ranges.items())]
+
+        if ordered:
+            streams = [Prefetch(fetch, prefetch) for fetch in fetches]
+            messages = merge([_flatten(stream) for stream in streams],
+                             key=lambda message: message["timestamp"])
+        else:
+            streams = [Interleave(fetches, prefetch)]
+            messages = _flatten(streams[0])
+
+        try:
+            for message in messages:
+                yield message
+        finally:
+            for stream in streams:
+                stream.close()
+
+    def seek(self, topic, partition, timestamp, index=None, offsets=None):
+        """Return the first offset whose message is at/after timestamp.
+
+        The partition's offset range (`offsets`, as from ranges(), fetched
+        if not given) is binary-searched with fetch probes; the latest
+        offset is returned if every message is older. `timestamp` is in
+        milliseconds, like message timestamps. Probed points are recorded
+        in `index` (an OffsetIndex), which also narrows the search.
+        """
+        low, high = offsets if offsets else self.ranges(topic)[partition]
+        if index is not None:
+            low, high = index.bounds(topic, partition, timestamp, low, high)
+
+        while low < high:
+            middle = (low + high) // 2
+            entries = self._fetch(topic, partition, middle)
+            if len(entries) == 0:
+                high = middle
+                continue
 
+            first, last = entries[0], entries[-1]
+            if index is not None:
+                for entry in (first, last):
+                    index.record(topic, partition, entry["next_offset"] - 1,
+                                 entry["message"]["timestamp"])
+
+            if last["message"]["timestamp"] < timestamp:
+                low = last["next_offset"]
+            elif first["message"]["timestamp"] >= timestamp:
+                high = middle
+            else:
+                for entry in entries:
+                    if entry["message"]["timestamp"] >= timestamp:
+                        return entry["next_offset"] - 1
+        return low
+
+    @staticmethod
+    def _envelope(schema, data):
+        """Serialise one message in its reporting envelope (bytes)."""
         data = data.copy()
         data["timestamp"] = int(time.time())
         data["hostname"] = platform.node()
 
-        message = json.dumps([{
+        return serializer.dumps({
             "id": str(uuid.uuid4()),
             "session": SESSION,
             "schema": schema,
             "version": 1,
             "data": data
-        }])
-
-        retry = 0
-        while retry < REPORTING_RETRY_LIMIT:
-            response = requests.post(
-                url,
-                auth=(self.username, self.token),
-                headers={"content-type": "application/json"},
-                data=message,
-                verify=self.https_verify)
-
-            if response.status_code == 204:
-                break
-            else:
-                logging.warning("http error %i; will retry (#%i)",
-                                response.status_code, retry + 1)
-                time.sleep(2 * 2 ** retry)
-                retry += 1
+        })
+
+    def _post(self, url, message):
+        """POST a JSON array of envelopes, retrying server errors."""
+        response = self.retry.call(partial(
+            self._request, "POST", url,
+            headers={"content-type": "application/json"}, data=message))
+
+        if response.status_code != 204:
+            raise RuntimeError("http error %i" % response.status_code)
+
+    def put(self, topic, schema, data):
+        """Post a single message to the API."""
+
+        url = "https://%s/v1/topic/%s" % (self.server, topic)
+
+        self._post(url, b"[" + self._envelope(schema, data) + b"]")
+
+    def put_many(self, topic, schema, items, threads=1,
+                 max_bytes=MAX_BATCH_BYTES, max_messages=MAX_BATCH_MESSAGES):
+        """Post many messages, packed into as few requests as the limits allow.
+
+        `items` may be any iterable (including a generator); it is consumed
+        lazily. Batches are posted, and retried, independently with up to
+        `threads` in flight on the shared executor. Returns the number of
+        batches posted.
+        """
+        url = "https://%s/v1/topic/%s" % (self.server, topic)
+        bodies = Batcher(max_bytes, max_messages).pack(
+            self._envelope(schema, data) for data in items)
+
+        if threads <= 1:
+            count = 0
+            for body in bodies:
+                self._post(url, body)
+                count += 1
+            return count
+
+        posted = shared_executor().imap_unordered(
+            partial(self._post, url), bodies, threads)
+        return sum(1 for _ in posted)
+
+
+def _flatten(batches):
+    """Yield the messages of (messages, next_offset) batches."""
+    for messages, _ in batches:
+        for message in messages:
+            yield message
+
+
+class Batcher:
+    """Pack serialised envelopes into JSON array request bodies.
+
+    A body is closed once adding another envelope would exceed `max_bytes`
+    or `max_messages`; an envelope larger than `max_bytes` goes alone.
+    """
+
+    def __init__(self, max_bytes=MAX_BATCH_BYTES,
+                 max_messages=MAX_BATCH_MESSAGES):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.envelopes = []
+        self.size = 2
+
+    def add(self, envelope):
+        """Add an envelope; return a completed body, if one was closed."""
+        body = None
+        if self.envelopes and (
+                self.size + 2 + len(envelope) > self.max_bytes or
+                len(self.envelopes) >= self.max_messages):
+            body = self.flush()
+        self.envelopes.append(envelope)
+        self.size += len(envelope) + (2 if len(self.envelopes) > 1 else 0)
+        return body
+
+    def flush(self):
+        """Return the pending body (None if empty) and start a new one."""
+        if not self.envelopes:
+            return None
+        body = b"[" + b", ".join(self.envelopes) + b"]"
+        self.envelopes = []
+        self.size = 2
+        return body
 
-        if retry == REPORTING_RETRY_LIMIT:
-            raise IOError("reached retry limit: giving up")
+    def pack(self, envelopes):
+        """Yield bodies for an iterable of envelopes, consumed lazily."""
+        for envelope in envelopes:
+            body = self.add(envelope)
+            if body is not None:
+                yield body
+        body = self.flush()
+        if body is not None:
+            yield body
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""
+Sparse on-disk index of message timestamps by offset.
+"""
+
+import threading
+
+from ..cachefile import cache_path, load_json, save_json
+
+
+def default_path(server):
+    """Per-server index file under ~/.cache/ersa-kr."""
+    return cache_path("index", server)
+
+
+class OffsetIndex:
+    """(offset, timestamp) points seen while seeking, per partition.
+
+    Message timestamps only grow with the offset within a partition, so
+    every known point narrows later searches: an answer lies after each
+    point older than the timestamp sought, and at or before each point
+    which is not.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.points = {}
+        self.load()
+
+    @staticmethod
+    def _key(topic, partition):
+        """Index key for one partition."""
+        return "%s/%i" % (topic, partition)
+
+    def load(self):
+        """Read the index file; a missing or corrupt file is an empty index."""
+        if self.path is None:
+            return
+        content = load_json(self.path)
+        if not content:
+            return
+        self.points = dict((key, dict((int(offset), timestamp)
+                                      for offset, timestamp in points))
+                           for key, points in content.items())
+
+    def save(self):
+        """Write the index file atomically."""
+        if self.path is None:
+            return
+        with self.lock:
+            content = dict((key, sorted(points.items()))
+                           for key, points in self.points.items())
+        save_json(self.path, content)
+
+    def record(self, topic, partition, offset, timestamp):
+        """Remember the timestamp of the message at offset."""
+        with self.lock:
+            self.points.setdefault(self._key(topic, partition),
+                                   {})[offset] = timestamp
+
+    def bounds(self, topic, partition, timestamp, low, high):
+        """Narrow [low, high] around the first offset at/after timestamp."""
+        with self.lock:
+            points = list(self.points.get(self._key(topic, partition),
+                                          {}).items())
+        for offset, point in points:
+            if point < timestamp:
+                low = max(low, offset + 1)
+            else:
+                high = min(high, offset)
+        return low, max(low, high)
@@ -8,45 +8,291 @@ Archive messages from the kafka-reporting API into OpenStack Swift.
 
 import io
 import json
+import logging
+import multiprocessing
+import os
 import re
+import threading
+import time
+
+from encodings import utf_8
 
-from backports import lzma
 from boto.s3.connection import S3Connection
 
-from .. import api
+from .. import api, serializer
+from . import codecs
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 REPORTING_RETRY_LIMIT = 10
 
+# Number of fetched batches to queue up ahead of the compressor.
+PREFETCH_DEPTH = 4
+
+# Number of partitions archived concurrently in multi-partition mode.
+ARCHIVE_WORKERS = 4
+
+# Uncompressed block size used when compressing in parallel on a pool.
+BLOCK_SIZE = 16 * 1024 * 1024
+
+# Serialised bytes collected before each call to a streaming compressor.
+WRITE_BATCH = 256 * 1024
+
+# Uncompressed bytes per archive object (default flush policy).
+OBJECT_SIZE = 256 * 1024 * 1024
+
+# Multipart upload part size (S3 minimum is 5 MiB), and the number of
+# filled parts which may wait for the uploader thread.
+PART_SIZE = 16 * 1024 * 1024
+UPLOAD_QUEUE = 2
+
+
+def _compress(codec_name, block, level):
+    """Compress one block with the named codec (pool worker)."""
+    return codecs.get(codec_name).compress(block, level)
+
 
 class Dump:
-    """An LZMA-compressing buffer for incrementally-built JSON arrays."""
+    """A compressing buffer for incrementally-built JSON arrays.
+
+    Without a pool, the array is compressed as a single stream. With a
+    multiprocessing pool of `workers` processes, the array is cut into
+    blocks of `block_size` bytes which are compressed in parallel; the
+    result is a concatenation of streams (e.g. .xz streams), which
+    readers of every codec decode as one.
+
+    Compressed bytes go to `sink` (any object with `write`) as they are
+    produced; without a sink they are kept in memory. Entries are
+    serialised by the configured serializer backend.
+    """
 
-    def __init__(self):
+    def __init__(self, codec=None, level=None, pool=None, workers=1,
+                 block_size=BLOCK_SIZE, sink=None):
         self.empty = True
-        self.buffer = io.BytesIO()
-        self.dump = lzma.open(self.buffer, mode="wt", preset=9)
-        self.dump.write(u"[")
+        self.messages = 0
+        self.size = 0
+        self.earliest_timestamp = None
+        self.latest_timestamp = None
+        self.sink = sink
+        self.buffer = sink if sink is not None else io.BytesIO()
+        self.codec = codec if codec else codecs.get(codecs.DEFAULT_CODEC)
+        self.level = level if level is not None else self.codec.level
+        self.pool = pool
+        self.dumps = serializer.current().dumps
+        self.block = []
+        self.block_bytes = 0
+        if pool is None:
+            self.compressor = self.codec.compressobj(self.level)
+            self.block_size = WRITE_BATCH
+        else:
+            self.block_size = block_size
+            # Bound memory: at most this many blocks compressing at once.
+            self.max_pending = 2 * workers
+            self.pending = []
+        self._write(b"[")
+
+    def _write(self, data):
+        """Append serialised bytes to the compressed output."""
+        self.block.append(data)
+        self.block_bytes += len(data)
+        if self.block_bytes >= self.block_size:
+            self._submit()
+        return len(data)
+
+    def _submit(self):
+        """Compress the current block (on the pool, collecting finished
+        blocks, if there is one)."""
+        block = b"".join(self.block)
+        self.block = []
+        self.block_bytes = 0
+        if self.pool is None:
+            self.buffer.write(self.compressor.compress(block))
+            return
+        self.pending.append(self.pool.apply_async(
+            _compress, (self.codec.name, block, self.level)))
+        while len(self.pending) >= self.max_pending:
+            self.buffer.write(self.pending.pop(0).get())
 
     def write(self, item):
         """Add an entry to the array."""
         if self.empty:
             self.empty = False
         else:
-            self.dump.write(u",")
-        return self.dump.write(json.dumps(item).decode())
+            self.size += self._write(b",")
+
+        timestamp = item.get("timestamp") if isinstance(item, dict) else None
+        if timestamp is not None:
+            if self.earliest_timestamp is None or \
+                    timestamp < self.earliest_timestamp:
+                self.earliest_timestamp = timestamp
+            if self.latest_timestamp is None or \
+                    timestamp > self.latest_timestamp:
+                self.latest_timestamp = timestamp
+
+        length = self._write(self.dumps(item))
+        self.messages += 1
+        self.size += length
+        return length
+
+    def summary(self):
+        """Message count, timestamp range and uncompressed size so far."""
+        return {
+            "messages": self.messages,
+            "earliest_timestamp": self.earliest_timestamp,
+            "latest_timestamp": self.latest_timestamp,
+            "bytes": self.size + 2
+        }
 
     def finish(self):
-        """Close the array and return the compressed result."""
-        self.dump.write(u"]")
-        self.dump.close()
+        """Close the array and return the compressed result (if no sink)."""
+        self._write(b"]")
+        self._submit()
+        if self.pool is None:
+            self.buffer.write(self.compressor.flush())
+        else:
+            for result in self.pending:
+                self.buffer.write(result.get())
+            self.pending = []
+        if self.sink is not None:
+            return None
         return self.buffer.getvalue()
 
 
+class Upload:
+    """A streaming object upload which sends parts as they fill.
+
+    Written bytes are buffered up to `part_size` and then handed to a
+    background thread for multipart upload while the caller keeps writing,
+    so memory is bounded by the part size rather than the object size.
+
+    The final object name is only known at commit, so multipart uploads go
+    to a temporary key which is then copied into place (server side) and
+    deleted. Objects smaller than one part are uploaded directly.
+    """
+
+    def __init__(self, bucket, temporary_name, part_size=PART_SIZE):
+        self.bucket = bucket
+        self.temporary_name = temporary_name
+        self.part_size = part_size
+        self.buffer = io.BytesIO()
+        self.multipart = None
+        self.parts = 0
+        self.queue = queue.Queue(maxsize=UPLOAD_QUEUE)
+        self.thread = None
+        self.error = None
+        self.size = 0
+
+    def write(self, data):
+        """Buffer data, uploading a part whenever one fills."""
+        self._check()
+        self.buffer.write(data)
+        self.size += len(data)
+        if self.buffer.tell() >= self.part_size:
+            self._flush_part()
+        return len(data)
+
+    def _check(self):
+        """Re-raise a failure from the uploader thread."""
+        if self.error is not None:
+            raise self.error
+
+    def _initiate(self):
+        """Start the multipart upload and its uploader thread.
+
+        Any multipart upload left behind at the same temporary name by a
+        killed run is cancelled first.
+        """
+        for stale in self.bucket.get_all_multipart_uploads(
+                prefix=self.temporary_name):
+            if stale.key_name == self.temporary_name:
+                stale.cancel_upload()
+
+        self.multipart = self.bucket.initiate_multipart_upload(
+            self.temporary_name)
+        self.thread = threading.Thread(target=self._upload_parts)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _flush_part(self):
+        """Queue the buffered bytes as the next part."""
+        if self.multipart is None:
+            self._initiate()
+
+        self.parts += 1
+        self.queue.put((self.parts, self.buffer.getvalue()))
+        self.buffer = io.BytesIO()
+
+    def _upload_parts(self):
+        """Uploader thread: send queued parts until told to stop."""
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            if self.error is not None:
+                continue
+            number, data = entry
+            try:
+                self.multipart.upload_part_from_file(io.BytesIO(data), number)
+            except Exception as exception:  # pylint: disable=broad-except
+                self.error = exception
+
+    def _stop(self):
+        """Wait for queued parts to be uploaded (or discarded)."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def commit(self, name):
+        """Finish the upload and store it as `name`."""
+        if self.multipart is None:
+            self.bucket.new_key(name).set_contents_from_string(
+                self.buffer.getvalue())
+            return
+
+        if self.buffer.tell() > 0:
+            self._flush_part()
+        self._stop()
+        multipart, self.multipart = self.multipart, None
+        try:
+            self._check()
+            multipart.complete_upload()
+        except Exception:
+            multipart.cancel_upload()
+            raise
+        # The upload is complete, so clean up its key rather than cancel it.
+        try:
+            self.bucket.copy_key(name, self.bucket.name, self.temporary_name)
+        except Exception:
+            try:
+                self.bucket.delete_key(self.temporary_name)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("could not delete %s", self.temporary_name)
+            raise
+        self.bucket.delete_key(self.temporary_name)
+
+    def abort(self):
+        """Discard the upload, leaving nothing behind in object store.
+
+        Once commit has been called, there is nothing left to discard.
+        """
+        self.buffer = io.BytesIO()
+        if self.multipart is None:
+            return
+        if self.error is None:
+            self.error = IOError("upload aborted")
+        self._stop()
+        self.multipart.cancel_upload()
+        self.multipart = None
+
+
 class Archive:
     """Handle all interactions (save, list) with Object Store through Boto."""
 
-    # clustername/topic/partition/offset1-offset2.json.xz
+    # clustername/topic/partition/offset1-offset2.json.<codec suffix>
     re_offset = re.compile(r".*/[0-9]+-([0-9]+)\..+")
+    re_range = re.compile(r".*/([0-9]+)-([0-9]+)\.json\.[^.]+$")
 
     def __init__(self, aws_id, aws_secret, server, bucket, object_prefix=""):
         aws_s3 = S3Connection(aws_access_key_id=aws_id,
@@ -58,68 +304,575 @@ class Archive:
         if len(object_prefix) > 0 and not object_prefix.endswith("/"):
             self.object_prefix += "/"
 
-    def save(self, topic, partition, start_offset, end_offset, content):
-        """Save an object in object store."""
-        dump_name = "%s%s/%s/%s-%s.json.xz" % (
+        self.manifests = {}
+        self.manifests_lock = threading.Lock()
+
+    def object_name(self, topic, partition, start_offset, end_offset,
+                    extension=".json.xz"):
+        """Name of the object holding the given offsets."""
+        return "%s%s/%s/%s-%s%s" % (
             self.object_prefix, topic, partition, str(start_offset).zfill(12),
-            str(end_offset).zfill(12))
+            str(end_offset).zfill(12), extension)
+
+    def save(self, topic, partition, start_offset, end_offset, content,
+             extension=".json.xz", summary=None):
+        """Save an object in object store.
+
+        `summary` (see Dump.summary) is recorded in the partition manifest.
+        """
+        dump_name = self.object_name(topic, partition, start_offset,
+                                     end_offset, extension)
 
         self.bucket.new_key(dump_name).set_contents_from_string(content)
+        self._add_to_manifest(topic, partition, dump_name, start_offset,
+                              end_offset, len(content), summary)
+        self._write_checkpoint(topic, partition, end_offset, dump_name)
+
+    def open(self, topic, partition, start_offset, extension=".json.xz",
+             part_size=PART_SIZE):
+        """Start a streaming upload of an object beginning at start_offset."""
+        temporary_name = "%s%s/%s/%s%s.partial" % (
+            self.object_prefix, topic, partition, str(start_offset).zfill(12),
+            extension)
+        return Upload(self.bucket, temporary_name, part_size)
+
+    def commit(self, upload, topic, partition, start_offset, end_offset,
+               extension=".json.xz", summary=None):
+        """Complete a streaming upload under its final object name.
+
+        `summary` (see Dump.summary) is recorded in the partition manifest.
+        """
+        dump_name = self.object_name(topic, partition, start_offset,
+                                     end_offset, extension)
+        upload.commit(dump_name)
+        self._add_to_manifest(topic, partition, dump_name, start_offset,
+                              end_offset, upload.size, summary)
+        self._write_checkpoint(topic, partition, end_offset, dump_name)
+
+    def _manifest_name(self, topic, partition):
+        """Name of the partition's manifest object."""
+        return "%s%s/%s/manifest.json" % (self.object_prefix, topic,
+                                          partition)
+
+    def manifest(self, topic, partition):
+        """Return the partition's manifest entries, ordered by offset.
+
+        Each entry describes one object: its name ("object"), offset range
+        ("start", "end"), "messages", "earliest_timestamp" and
+        "latest_timestamp" (milliseconds), and uncompressed and stored
+        sizes ("bytes", "stored_bytes"). Objects archived before manifests
+        were kept are not listed.
+        """
+        key_name = self._manifest_name(topic, partition)
+        with self.manifests_lock:
+            if key_name not in self.manifests:
+                key = self.bucket.get_key(key_name)
+                content = key.get_contents_as_string() if key else b""
+                self.manifests[key_name] = [
+                    json.loads(line) for line in content.splitlines()
+                    if line.strip()]
+            return list(self.manifests[key_name])
+
+    def _add_to_manifest(self, topic, partition, dump_name, start_offset,
+                         end_offset, stored_bytes, summary=None):
+        """Add (or replace) an object's entry and rewrite the manifest.
+
+        The manifest is one JSON entry per line; a single PUT replaces it
+        atomically.
+        """
+        entry = {
+            "object": dump_name,
+            "start": start_offset,
+            "end": end_offset,
+            "messages": None,
+            "earliest_timestamp": None,
+            "latest_timestamp": None,
+            "bytes": None,
+            "stored_bytes": stored_bytes
+        }
+        entry.update(summary or {})
+
+        entries = [existing for existing in self.manifest(topic, partition)
+                   if existing["object"] != dump_name]
+        entries.append(entry)
+        entries.sort(key=lambda existing: existing["start"])
+
+        key_name = self._manifest_name(topic, partition)
+        content = "".join(json.dumps(existing, sort_keys=True) + "\n"
+                          for existing in entries)
+        self.bucket.new_key(key_name).set_contents_from_string(content)
+        with self.manifests_lock:
+            self.manifests[key_name] = entries
+
+    def objects(self, topic, partition):
+        """Return (start, end, name) of each archived object, by offset."""
+        objects = []
+        for item in self.bucket.list("%s%s/%i/" % (self.object_prefix,
+                                                   topic, partition)):
+            match = self.re_range.match(item.name)
+            if match:
+                objects.append((int(match.group(1)), int(match.group(2)),
+                                item.name))
+        return sorted(objects)
+
+    def read(self, name):
+        """Yield lists of the messages in an object, as they are read.
+
+        The object is downloaded, decompressed and parsed incrementally,
+        so memory use does not depend on the object's size.
+        """
+        codec = codecs.for_object(name)
+        key = self.bucket.get_key(name)
+        if key is None:
+            raise IOError("no such object: %s" % name)
+        try:
+            for messages in parse_array(codec.iter_decompress(key)):
+                yield messages
+        finally:
+            key.close()
+
+    def partitions(self, topic):
+        """Return the partitions of topic which have archived objects."""
+        prefix = "%s%s/" % (self.object_prefix, topic)
+        partitions = []
+        for item in self.bucket.list(prefix, delimiter="/"):
+            try:
+                partitions.append(int(item.name[len(prefix):].strip("/")))
+            except ValueError:
+                pass
+        return sorted(partitions)
+
+    def _checkpoint_name(self, topic, partition):
+        """Name of the partition's checkpoint object."""
+        return "%s%s/%s/checkpoint.json" % (self.object_prefix, topic,
+                                            partition)
+
+    def _read_checkpoint(self, topic, partition):
+        """Return the partition's checkpoint, or None if there is none."""
+        key = self.bucket.get_key(self._checkpoint_name(topic, partition))
+        if key is None:
+            return None
+        return json.loads(key.get_contents_as_string())
+
+    def _write_checkpoint(self, topic, partition, end_offset, dump_name):
+        """Record the highest archived offset and the object holding it.
+
+        A single PUT replaces the checkpoint atomically.
+        """
+        checkpoint = json.dumps({"offset": end_offset, "object": dump_name})
+        self.bucket.new_key(self._checkpoint_name(
+            topic, partition)).set_contents_from_string(checkpoint)
+
+    def latest(self, topic, partition, verify=False):
+        """Find the highest kafka-reporting offset in object store.
+
+        Normally only the partition's checkpoint and the objects named
+        after the one it records are read. With verify=True, or when there
+        is no checkpoint yet, every object is listed and the checkpoint is
+        rewritten from the listing.
+        """
+        checkpoint = self._read_checkpoint(topic, partition)
+        if checkpoint is not None and not verify:
+            end_offset = checkpoint["offset"]
+            end_name = checkpoint["object"]
+        else:
+            end_offset = 0
+            end_name = ""
 
-    def latest(self, topic, partition):
-        """Find the highest kafka-reporting offset in object store."""
         list_all = self.bucket.list("%s%s/%i/" % (
-            self.object_prefix, topic, partition))
+            self.object_prefix, topic, partition), marker=end_name)
 
-        end_offset = 0
         for item in list_all:
             try:
                 offset = int(self.re_offset.match(item.name).group(1))
                 if offset > end_offset:
                     end_offset = offset
+                    end_name = item.name
             except AttributeError:
                 pass
+
+        if checkpoint is not None and checkpoint["offset"] != end_offset:
+            logging.warning("checkpoint for %s/%i at offset %i, "
+                            "objects found up to %i", topic, partition,
+                            checkpoint["offset"], end_offset)
+        if end_name and (checkpoint is None or
+                         checkpoint["object"] != end_name):
+            self._write_checkpoint(topic, partition, end_offset, end_name)
         return end_offset
 
 
+class FlushPolicy:
+    """Decide when an object is complete: by size, message count or age.
+
+    Any limit left as None is not applied.
+    """
+
+    def __init__(self, max_bytes=OBJECT_SIZE, max_messages=None,
+                 max_seconds=None):
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.max_seconds = max_seconds
+
+    def due(self, bytes_written, items_written, started):
+        """Whether an object started at `started` should be saved now."""
+        if self.max_bytes and bytes_written >= self.max_bytes:
+            return True
+        if self.max_messages and items_written >= self.max_messages:
+            return True
+        if self.max_seconds and time.time() - started >= self.max_seconds:
+            return True
+        return False
+
+
+class Spool:
+    """A local journal of the batches in the object being built.
+
+    The first line records the object's start offset; each fetched batch
+    is appended as one JSON line and fsync'ed, so a restarted run can
+    replay the batches instead of fetching them again.
+    """
+
+    def __init__(self, directory, topic, partition):
+        self.path = os.path.join(directory,
+                                 "%s.%i.spool" % (topic, partition))
+        self.handle = None
+
+    def _sync(self):
+        """Make appended lines durable."""
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def start(self, start_offset):
+        """Begin an empty journal for an object starting at start_offset.
+
+        The new journal replaces the old one atomically (by rename).
+        """
+        self.close()
+        temporary = self.path + ".new"
+        self.handle = open(temporary, "wb")
+        self.handle.write(json.dumps({"start_offset": start_offset}) + "\n")
+        self._sync()
+        os.rename(temporary, self.path)
+
+    def append(self, data, next_offset):
+        """Journal one batch."""
+        self.handle.write(json.dumps({"next_offset": next_offset,
+                                      "messages": data}) + "\n")
+        self._sync()
+
+    def replay(self, start_offset):
+        """Yield (messages, next_offset) batches journalled for start_offset.
+
+        A journal for any other start offset is stale and is discarded. A
+        torn last line (from a crash mid-write) is dropped. Afterwards the
+        journal is open for appending, unless a new one was started while
+        replaying.
+        """
+        if not os.path.exists(self.path):
+            self.start(start_offset)
+            return
+
+        with open(self.path, "rb") as handle:
+            try:
+                header = json.loads(handle.readline())
+            except ValueError:
+                header = {}
+            if header.get("start_offset") != start_offset:
+                logging.warning("discarding stale spool %s", self.path)
+                handle.close()
+                self.start(start_offset)
+                return
+
+            good = handle.tell()
+            while True:
+                line = handle.readline()
+                if not line.endswith("\n"):
+                    break
+                try:
+                    batch = json.loads(line)
+                except ValueError:
+                    break
+                good = handle.tell()
+                yield batch["messages"], batch["next_offset"]
+
+        if self.handle is None:
+            self.handle = open(self.path, "r+b")
+            self.handle.truncate(good)
+            self.handle.seek(good)
+
+    def close(self):
+        """Close the journal, keeping it on disk."""
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def clear(self):
+        """Remove the journal once its object is safely stored."""
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
 class Stream:
     """Handle all interactions with the kafka-reporting API."""
 
-    def __init__(self, server, username, token, archive, https_verify=True):
+    def __init__(self, server, username, token, archive, https_verify=True,
+                 prefetch=PREFETCH_DEPTH, codec=None, level=None,
+                 topic_codecs=None, compress_workers=1, part_size=PART_SIZE,
+                 flush_policy=None, spool_dir=None):
         self.archive = archive
         self.api = api.API(server, username, token, https_verify)
+        self.prefetch = prefetch
+        self.codec = codec if codec else codecs.get(codecs.DEFAULT_CODEC)
+        self.level = level
+        self.topic_codecs = topic_codecs if topic_codecs else {}
+        self.compress_workers = compress_workers
+        self.part_size = part_size
+        self.flush_policy = flush_policy if flush_policy else FlushPolicy()
+        self.spool_dir = spool_dir
+        self.pool = None
+        if compress_workers > 1:
+            self.pool = multiprocessing.Pool(compress_workers)
 
-    def stream(self, topic, partition, offset=0):
-        """Fetch all messages from the given offset up to the latest offset."""
+    def close(self):
+        """Shut down the compression pool, if any."""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def _dump(self, topic, partition, start_offset):
+        """Start a new dump, in the topic's codec, streaming to storage."""
+        codec, level = self.topic_codecs.get(topic, (self.codec, self.level))
+        upload = self.archive.open(topic, partition, start_offset,
+                                   codec.extension(), self.part_size)
+        return Dump(codec, level, self.pool, self.compress_workers,
+                    sink=upload)
+
+    def _save(self, dump, topic, partition, start_offset, end_offset):
+        """Finish a dump and commit its upload."""
+        dump.finish()
+        self.archive.commit(dump.sink, topic, partition, start_offset,
+                            end_offset, dump.codec.extension(),
+                            dump.summary())
+
+    def _resume(self, topic, partition, offset, spool, end=None):
+        """Yield (messages, next_offset, fetched) batches from offset.
+
+        Batches journalled in the spool are replayed first; fetching
+        continues from where they end, up to `end` if given.
+        """
+        if spool is not None:
+            for data, next_offset in spool.replay(offset):
+                yield data, next_offset, False
+                offset = next_offset
+
+        batches = self.api.iter_batches(topic, partition, offset, end,
+                                        prefetch=self.prefetch)
+        try:
+            for data, next_offset in batches:
+                yield data, next_offset, True
+        finally:
+            batches.close()
+
+    def stream(self, topic, partition, offset=0, max_objects=None,
+               end=None):
+        """Fetch all messages from the given offset up to the latest offset.
+
+        Batches are fetched by a background thread, up to `prefetch` ahead
+        of the compressor, so HTTP and compression overlap. Compressed
+        output is uploaded in parts while the object is still being built;
+        on failure the unfinished upload is aborted. Objects are saved when
+        the flush policy says so.
+
+        With a spool directory, fetched batches are also journalled to
+        disk, so a run restarted at the same offset resumes from the last
+        fetched batch.
+
+        If `end` is given, stop before that offset instead. If
+        `max_objects` is given, stop after saving that many objects and
+        return the offset to resume from; otherwise (or once the last
+        offset is reached) return None.
+        """
         start_offset = offset
+        objects_saved = 0
 
         items_written = 0
         bytes_written = 0
+        started = time.time()
 
-        dump = Dump()
+        spool = None
+        if self.spool_dir:
+            spool = Spool(self.spool_dir, topic, partition)
 
-        while True:
-            data, next_offset = self.api.get(topic, partition, offset)
+        dump = self._dump(topic, partition, start_offset)
+
+        # Replayed batches only need journalling again once a new journal
+        # has been started part-way through the replay.
+        restarted = False
+
+        batches = self._resume(topic, partition, offset, spool, end)
+        try:
+            for data, next_offset, fetched in batches:
+                if spool is not None and (fetched or restarted):
+                    spool.append(data, next_offset)
+
+                for item in data:
+                    bytes_written += dump.write(item)
+                    items_written += 1
+
+                if self.flush_policy.due(bytes_written, items_written,
+                                         started):
+                    self._save(dump, topic, partition, start_offset,
+                               start_offset + items_written - 1)
+                    dump = None
+                    if spool is not None:
+                        spool.start(next_offset)
+                        restarted = True
+
+                    objects_saved += 1
+                    if max_objects and objects_saved >= max_objects:
+                        return next_offset
+
+                    items_written = 0
+                    bytes_written = 0
+                    started = time.time()
+                    start_offset = next_offset
+                    dump = self._dump(topic, partition, start_offset)
 
-            if data is None:
-                if not dump.empty:
-                    self.archive.save(topic, partition, start_offset,
-                                      start_offset + items_written - 1,
-                                      dump.finish())
+            if not dump.empty:
+                self._save(dump, topic, partition, start_offset,
+                           start_offset + items_written - 1)
+            else:
+                dump.sink.abort()
+            dump = None
+            if spool is not None:
+                spool.clear()
+        except Exception:
+            if dump is not None:
+                dump.sink.abort()
+            raise
+        finally:
+            batches.close()
+            if spool is not None:
+                spool.close()
+        return None
+
+
+def parse_array(chunks):
+    """Yield lists of the items of a JSON array, parsed as bytes arrive.
+
+    `chunks` yields the UTF-8 encoded array piece by piece; each list
+    holds the items completed by one piece.
+    """
+    decoder = json.JSONDecoder()
+    text = utf_8.IncrementalDecoder()
+    buffer = u""
+    position = 0
+    state = "open"
+
+    for chunk in chunks:
+        buffer = buffer[position:] + text.decode(chunk)
+        position = 0
+        items = []
+        while state != "closed":
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer):
                 break
 
-            for item in data:
-                bytes_written += dump.write(item)
-                items_written += 1
+            character = buffer[position]
+            if state == "open":
+                if character != u"[":
+                    raise ValueError("not a JSON array")
+                position += 1
+                state = "first"
+            elif state == "separator" or (state == "first" and
+                                          character == u"]"):
+                if character == u"]":
+                    state = "closed"
+                elif character == u"," and state == "separator":
+                    state = "item"
+                else:
+                    raise ValueError("malformed JSON array")
+                position += 1
+            else:
+                # An item reaching the end of the buffer may be incomplete
+                # (e.g. a number), so wait for what follows it.
+                try:
+                    item, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    break
+                if end == len(buffer):
+                    break
+                items.append(item)
+                position = end
+                state = "separator"
+        if items:
+            yield items
+
+    if state != "closed":
+        raise ValueError("truncated JSON array")
+
+
+def covering(entries, since=None, until=None, offset=None):
+    """Select the manifest entries overlapping a time window or offset.
+
+    `since` and `until` are timestamps in milliseconds (until exclusive);
+    entries without timestamps are kept, as they cannot be ruled out.
+    """
+    selected = []
+    for entry in entries:
+        if offset is not None and not entry["start"] <= offset <= \
+                entry["end"]:
+            continue
+        if since is not None and entry["latest_timestamp"] is not None and \
+                entry["latest_timestamp"] < since:
+            continue
+        if until is not None and entry["earliest_timestamp"] is not None \
+                and entry["earliest_timestamp"] >= until:
+            continue
+        selected.append(entry)
+    return selected
 
-            if bytes_written >= 256 * 1024 * 1024:
-                self.archive.save(topic, partition, start_offset,
-                                  start_offset + items_written - 1,
-                                  dump.finish())
 
-                dump = Dump()
-                items_written = 0
-                bytes_written = 0
-                start_offset = next_offset
+def archive_partitions(stream, jobs, workers=ARCHIVE_WORKERS):
+    """Archive many (topic, partition, offset, end) jobs concurrently.
+
+    `end` is the offset to stop before, or None for the latest offset.
+
+    Each turn archives at most one object from a partition and then puts
+    the partition at the back of the queue, so partitions with a large
+    backlog cannot starve small ones. Returns the (topic, partition) pairs
+    which failed; failures are logged and do not stop other partitions.
+    """
+    pending = queue.Queue()
+    for job in jobs:
+        pending.put(job)
+
+    failed = []
+
+    def worker():
+        """Take turns until no partition has work left."""
+        while True:
+            try:
+                topic, partition, offset, end = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                offset = stream.stream(topic, partition, offset,
+                                       max_objects=1, end=end)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("archive failure: %s/%i", topic, partition)
+                failed.append((topic, partition))
+                continue
+            if offset is not None:
+                pending.put((topic, partition, offset, end))
+            else:
+                logging.info("archive complete: %s/%i", topic, partition)
 
-            offset = next_offset
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return failed
@@ -8,8 +8,12 @@ Archive messages from the kafka-reporting API into object store on AWS.
 import sys
 import os
 
-from .. import REQUIRED_ENVIRONMENT_REPORTING, REQUIRED_ENVIRONMENT_AWS
-from . import Archive, Stream
+from .. import REQUIRED_ENVIRONMENT_REPORTING, REQUIRED_ENVIRONMENT_AWS, api
+from ..api.index import OffsetIndex, default_path
+from . import Archive, FlushPolicy, Stream, archive_partitions, codecs
+from . import ARCHIVE_WORKERS, OBJECT_SIZE, PART_SIZE, PREFETCH_DEPTH
+
+MEBIBYTE = 1024 * 1024
 
 COMMAND = "archive"
 DESCRIPTION = "Consumer: archive content into object store."
@@ -19,11 +23,13 @@ def setup(subparser):
     """Archive CLI setup."""
     subparser.add_argument("--topic",
                            required=True,
-                           help="kafka-reporting topic")
+                           nargs="+",
+                           help="kafka-reporting topic(s), or 'all'")
     subparser.add_argument("--partition",
                            type=int,
-                           required=True,
-                           help="kafka-reporting partition")
+                           nargs="+",
+                           help="kafka-reporting partition(s) "
+                           "(default all partitions)")
     subparser.add_argument("--namespace",
                            required=True,
                            help="AWS namespace")
@@ -32,7 +38,126 @@ def setup(subparser):
                            help="object prefix (default '')")
     subparser.add_argument("--offset",
                            type=int,
-                           help="override start offset (default automatic)")
+                           help="override start offset (default automatic); "
+                           "requires a single topic and partition")
+    subparser.add_argument("--since",
+                           type=api.parse_time,
+                           help="skip messages older than this ISO 8601 time "
+                           "(archived offsets are never re-archived)")
+    subparser.add_argument("--until",
+                           type=api.parse_time,
+                           help="stop at the first message at or after this "
+                           "ISO 8601 time")
+    subparser.add_argument("--verify",
+                           action="store_true",
+                           help="find the start offset by listing every "
+                           "archived object instead of trusting checkpoints")
+    subparser.add_argument("--prefetch",
+                           type=int,
+                           default=PREFETCH_DEPTH,
+                           help="batches to fetch ahead of compression "
+                           "(default %i)" % PREFETCH_DEPTH)
+    subparser.add_argument("--workers",
+                           type=int,
+                           default=ARCHIVE_WORKERS,
+                           help="partitions to archive concurrently "
+                           "(default %i)" % ARCHIVE_WORKERS)
+    subparser.add_argument("--codec",
+                           default=codecs.DEFAULT_CODEC,
+                           help="compression codec[:level], one of %s "
+                           "(default %s)" % (", ".join(sorted(codecs.CODECS)),
+                                             codecs.DEFAULT_CODEC))
+    subparser.add_argument("--topic-codec",
+                           action="append",
+                           default=[],
+                           metavar="TOPIC=CODEC[:LEVEL]",
+                           help="codec for one topic (repeatable)")
+    subparser.add_argument("--compress-workers",
+                           type=int,
+                           default=1,
+                           help="processes compressing blocks in parallel; "
+                           "each needs up to ~700 MiB at xz level 9 "
+                           "(default 1: single-stream compression)")
+    subparser.add_argument("--part-size",
+                           type=int,
+                           default=PART_SIZE // MEBIBYTE,
+                           help="multipart upload part size in MiB, "
+                           "at least 5 (default %i)" % (PART_SIZE // MEBIBYTE))
+    subparser.add_argument("--max-bytes",
+                           type=int,
+                           default=OBJECT_SIZE // MEBIBYTE,
+                           help="save an object once it holds this many MiB "
+                           "uncompressed (default %i)" %
+                           (OBJECT_SIZE // MEBIBYTE))
+    subparser.add_argument("--max-messages",
+                           type=int,
+                           help="save an object once it holds this many "
+                           "messages (default no limit)")
+    subparser.add_argument("--max-seconds",
+                           type=int,
+                           help="save an object once it has been building "
+                           "for this many seconds (default no limit)")
+    subparser.add_argument("--spool-dir",
+                           help="journal fetched batches here so an "
+                           "interrupted run resumes without re-fetching")
+
+
+def _start_offset(archive, topic, partition, verify=False):
+    """First offset not yet in object store."""
+    latest_stored_offset = archive.latest(topic, partition, verify)
+    if latest_stored_offset > 0:
+        latest_stored_offset += 1
+    return latest_stored_offset
+
+
+def _codecs(args):
+    """Parse the default codec and per-topic codecs."""
+    try:
+        codec, level = codecs.parse(args.codec)
+        topic_codecs = {}
+        for spec in args.topic_codec:
+            topic, _, codec_spec = spec.partition("=")
+            topic_codecs[topic] = codecs.parse(codec_spec)
+    except ValueError as error:
+        sys.exit(str(error))
+    return codec, level, topic_codecs
+
+
+def _window(args, kafka, index, topic, partition, offset, offsets):
+    """Apply --since/--until to a start offset; return (start, end).
+
+    `offsets` is the partition's (earliest, latest) offset range.
+    """
+    end = None
+    if args.since is not None:
+        offset = max(offset, kafka.seek(topic, partition, args.since, index,
+                                        offsets))
+    if args.until is not None:
+        end = kafka.seek(topic, partition, args.until, index, offsets)
+    return offset, end
+
+
+def _jobs(args, archive, kafka, index):
+    """Build (topic, partition, offset, end) jobs, smallest backlog first."""
+    if args.topic == ["all"]:
+        topics = kafka.topics()
+    else:
+        topics = args.topic
+
+    jobs = []
+    for topic in topics:
+        for partition_id, offsets in kafka.ranges(topic).items():
+            if args.partition and partition_id not in args.partition:
+                continue
+            offset = _start_offset(archive, topic, partition_id,
+                                   args.verify)
+            offset, end = _window(args, kafka, index, topic, partition_id,
+                                  offset, offsets)
+            backlog = (offsets[1] if end is None else end) - offset
+            if backlog > 0:
+                jobs.append((backlog, (topic, partition_id, offset, end)))
+
+    return [job for _, job in sorted(jobs)]
 
 
 def execute(args):
@@ -47,6 +172,16 @@ def execute(args):
         sys.exit("Missing environment variables: %s" %
                  " ".join(missing_environment))
 
+    single = (len(args.topic) == 1 and args.topic != ["all"] and
+              args.partition is not None and len(args.partition) == 1)
+    if args.offset is not None and not single:
+        sys.exit("--offset requires a single --topic and --partition")
+
+    if args.part_size < 5:
+        sys.exit("--part-size must be at least 5 (MiB)")
+
+    codec, level, topic_codecs = _codecs(args)
+
     aws_id = os.getenv("OS_AWS_ID")
     aws_secret = os.getenv("OS_AWS_SECRET")
     aws_server = os.getenv("OS_AWS_URL")
@@ -61,14 +196,44 @@ def execute(args):
         "username": os.getenv("REPORTING_USERNAME"),
         "token": os.getenv("REPORTING_TOKEN"),
         "archive": archive,
-        "https_verify": not args.insecure
+        "https_verify": not args.insecure,
+        "prefetch": args.prefetch,
+        "codec": codec,
+        "level": level,
+        "topic_codecs": topic_codecs,
+        "compress_workers": args.compress_workers,
+        "part_size": args.part_size * MEBIBYTE,
+        "flush_policy": FlushPolicy(args.max_bytes * MEBIBYTE,
+                                    args.max_messages, args.max_seconds),
+        "spool_dir": args.spool_dir
     }
 
     stream = Stream(**stream_config)
+    index = OffsetIndex(default_path(stream_config["server"]))
 
-    latest_stored_offset = archive.latest(
-        args.topic, args.partition) if not args.offset else args.offset
-    if latest_stored_offset > 0 and not args.offset:
-        latest_stored_offset += 1
+    try:
+        if single:
+            topic, partition = args.topic[0], args.partition[0]
+            if args.offset is not None:
+                offset = args.offset
+            else:
+                offset = _start_offset(archive, topic, partition,
+                                       args.verify)
+            end = None
+            if args.since is not None or args.until is not None:
+                offset, end = _window(args, stream.api, index, topic,
+                                      partition, offset,
+                                      stream.api.ranges(topic)[partition])
+                index.save()
+            stream.stream(topic, partition, offset, end=end)
+            return
+
+        jobs = _jobs(args, archive, stream.api, index)
+        index.save()
+        failed = archive_partitions(stream, jobs, args.workers)
+    finally:
+        stream.close()
 
-    stream.stream(args.topic, args.partition, latest_stored_offset)
+    if len(failed) > 0:
+        sys.exit("Archive failed for: %s" % " ".join(
+            "%s/%i" % (topic, partition) for topic, partition in failed))
@@ -0,0 +1,213 @@
+#!/usr/bin/env python2
+"""
+Compression codecs for archive objects.
+
+xz and gzip are always available; zstd and lz4 are registered only when
+the optional zstandard and lz4 packages are installed.
+"""
+
+# pylint: disable=import-error,too-few-public-methods,too-many-arguments
+
+import io
+import zlib
+
+from backports import lzma
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+CODECS = {}
+
+DEFAULT_CODEC = "xz"
+
+# Compressed bytes read at a time when decompressing a stream.
+CHUNK_SIZE = 64 * 1024
+
+
+class Codec:
+    """A compression format usable for archive objects.
+
+    `compress(data, level)` and `decompress(data)` handle one block;
+    concatenated compressed blocks must decode as the concatenation of
+    their inputs, so blocks may be compressed independently.
+    `compressobj(level)` returns a streaming compressor with
+    `compress(data)` and `flush()`. `iter_decompress(fileobj)` yields the
+    decompressed contents of a file object (any number of concatenated
+    blocks) piece by piece, reading `CHUNK_SIZE` bytes at a time.
+    """
+
+    def __init__(self, name, suffix, level, compress, decompress,
+                 compressobj, iter_decompress):
+        self.name = name
+        self.suffix = suffix
+        self.level = level
+        self.compress = compress
+        self.decompress = decompress
+        self.compressobj = compressobj
+        self.iter_decompress = iter_decompress
+
+    def extension(self):
+        """Object name extension for JSON arrays in this format."""
+        return ".json.%s" % self.suffix
+
+
+def register(codec):
+    """Make a codec available by name."""
+    CODECS[codec.name] = codec
+
+
+def get(name):
+    """Look up a codec by name."""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("unknown codec %s (available: %s)" %
+                         (name, ", ".join(sorted(CODECS))))
+
+
+def parse(spec):
+    """Parse "name[:level]" into (codec, level or None)."""
+    name, _, level = spec.partition(":")
+    return get(name), int(level) if level else None
+
+
+def for_object(name):
+    """Look up the codec of an archive object by its name's extension."""
+    for codec in CODECS.values():
+        if name.endswith(codec.extension()):
+            return codec
+    raise ValueError("no codec for %s" % name)
+
+
+def _iter_streams(decompressobj):
+    """Build an iter_decompress for concatenated streams.
+
+    `decompressobj()` returns a decompressor for one stream, which leaves
+    whatever follows the end of its stream in `unused_data` (and may set
+    `eof`); a fresh decompressor takes over from there.
+    """
+    def iter_decompress(fileobj):
+        """Yield the decompressed contents of fileobj, piece by piece."""
+        decompressor = decompressobj()
+        while True:
+            data = fileobj.read(CHUNK_SIZE)
+            if not data:
+                return
+            while data:
+                output = decompressor.decompress(data)
+                if output:
+                    yield output
+                data = decompressor.unused_data
+                if data or getattr(decompressor, "eof", False):
+                    decompressor = decompressobj()
+    return iter_decompress
+
+
+def _decompress_all(iter_decompress):
+    """Build a decompress for concatenated blocks from an iter_decompress."""
+    def decompress(data):
+        """Decompress data, which may hold several concatenated blocks."""
+        return b"".join(iter_decompress(io.BytesIO(data)))
+    return decompress
+
+
+def _xz_compress(data, level):
+    """Compress data into one .xz stream."""
+    return lzma.compress(data, preset=level)
+
+
+def _xz_compressobj(level):
+    """Streaming .xz compressor."""
+    return lzma.LZMACompressor(preset=level)
+
+
+def _gzip_compressobj(level):
+    """Streaming compressor writing one gzip member."""
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def _gzip_compress(data, level):
+    """Compress data into one gzip member."""
+    compressor = _gzip_compressobj(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _gzip_decompressobj():
+    """Streaming decompressor for one gzip member."""
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+
+register(Codec("xz", "xz", 9, _xz_compress, lzma.decompress,
+               _xz_compressobj, _iter_streams(lzma.LZMADecompressor)))
+_GZIP_ITER_DECOMPRESS = _iter_streams(_gzip_decompressobj)
+
+register(Codec("gzip", "gz", 6, _gzip_compress,
+               _decompress_all(_GZIP_ITER_DECOMPRESS), _gzip_compressobj,
+               _GZIP_ITER_DECOMPRESS))
+
+
+if zstandard is not None:
+    def _zstd_compress(data, level):
+        """Compress data into one zstd frame."""
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def _zstd_iter_decompress(fileobj):
+        """Yield the decompressed contents of fileobj, piece by piece."""
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            fileobj, read_size=CHUNK_SIZE, read_across_frames=True)
+        while True:
+            data = reader.read(CHUNK_SIZE)
+            if not data:
+                return
+            yield data
+
+    def _zstd_compressobj(level):
+        """Streaming zstd compressor."""
+        return zstandard.ZstdCompressor(level=level).compressobj()
+
+    # decompressobj() would stop after the first frame.
+    register(Codec("zstd", "zst", 3, _zstd_compress,
+                   _decompress_all(_zstd_iter_decompress), _zstd_compressobj,
+                   _zstd_iter_decompress))
+
+
+if lz4 is not None:
+    class _LZ4Compressor:
+        """Adapt LZ4FrameCompressor to the compress/flush interface."""
+
+        def __init__(self, level):
+            self.compressor = lz4.frame.LZ4FrameCompressor(
+                compression_level=level)
+            self.started = False
+
+        def _begin(self):
+            """Frame header, the first time only."""
+            if self.started:
+                return b""
+            self.started = True
+            return self.compressor.begin()
+
+        def compress(self, data):
+            """Compress a piece of data."""
+            return self._begin() + self.compressor.compress(data)
+
+        def flush(self):
+            """Finish the frame."""
+            return self._begin() + self.compressor.flush()
+
+    def _lz4_compress(data, level):
+        """Compress data into one lz4 frame."""
+        return lz4.frame.compress(data, compression_level=level)
+
+    _LZ4_ITER_DECOMPRESS = _iter_streams(lz4.frame.LZ4FrameDecompressor)
+
+    register(Codec("lz4", "lz4", 0, _lz4_compress,
+                   _decompress_all(_LZ4_ITER_DECOMPRESS), _LZ4Compressor,
+                   _LZ4_ITER_DECOMPRESS))
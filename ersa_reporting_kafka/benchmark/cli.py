@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Archive codec benchmark on real reporting messages, and JSON serializer
+benchmark on synthetic ones.
+"""
+
+# pylint: disable=import-error,import-self
+
+import os
+import random
+import sys
+import time
+import uuid
+
+from tabulate import tabulate
+
+from .. import REQUIRED_ENVIRONMENT_REPORTING, api, serializer
+from ..archive import Dump, codecs
+
+COMMAND = "benchmark"
+DESCRIPTION = "Compare archive codecs (MB/s, ratio) on sample messages."
+
+HEADING = ["Codec", "Level", "Input MB", "Output MB", "Ratio",
+           "Compress MB/s", "Decompress MB/s"]
+
+SERIALIZER_HEADING = ["Serializer", "Identical", "Output MB", "Messages/s",
+                      "MB/s", "Dump (gzip:1) messages/s"]
+
+MEGABYTE = 1024.0 * 1024.0
+
+
+def setup(subparser):
+    """Benchmark CLI setup."""
+    subparser.add_argument("--topic",
+                           help="kafka-reporting topic to sample "
+                           "(required unless --serializers)")
+    subparser.add_argument("--partition",
+                           type=int,
+                           default=0,
+                           help="kafka-reporting partition (default 0)")
+    subparser.add_argument("--offset",
+                           type=int,
+                           help="first offset to sample "
+                           "(default earliest available)")
+    subparser.add_argument("--batches",
+                           type=int,
+                           default=20,
+                           help="batches of messages to sample (default 20)")
+    subparser.add_argument("--codec",
+                           action="append",
+                           metavar="CODEC[:LEVEL]",
+                           help="codec to benchmark (repeatable; "
+                           "default every available codec)")
+    subparser.add_argument("--serializers",
+                           action="store_true",
+                           help="benchmark the installed JSON serializers "
+                           "on synthetic messages instead (no Kafka access)")
+    subparser.add_argument("--messages",
+                           type=int,
+                           default=50000,
+                           help="synthetic messages for --serializers "
+                           "(default 50000)")
+
+
+def _sample(kafka, topic, partition, offset, batches):
+    """Fetch up to `batches` batches of messages."""
+    messages = []
+    for _ in range(batches):
+        data, offset = kafka.get(topic, partition, offset)
+        if data is None:
+            break
+        messages.extend(data)
+    return messages
+
+
+def _synthetic(count):
+    """Reporting envelopes resembling nova/cinder snapshots."""
+    generator = random.Random(0)
+    session = str(uuid.UUID(int=generator.getrandbits(128)))
+    messages = []
+    for index in range(count):
+        messages.append({
+            "id": str(uuid.UUID(int=generator.getrandbits(128))),
+            "session": session,
+            "schema": "nova",
+            "version": 1,
+            "timestamp": 1539648000000 + index,
+            "data": {
+                "timestamp": 1539648000 + index // 100,
+                "hostname": "reporting-%02i.example.org" % (index % 4),
+                "id": str(uuid.UUID(int=generator.getrandbits(128))),
+                "name": u"instance-%06i \u00e9" % index,
+                "status": generator.choice(["ACTIVE", "SHUTOFF", "ERROR"]),
+                "flavor": {"id": str(generator.randint(1, 20))},
+                "vcpus": generator.choice([1, 2, 4, 8, 16]),
+                "ram": generator.choice([4096, 8192, 65536]),
+                "load": generator.random() * 16,
+                "tags": ["project:%i" % generator.randint(1, 500)],
+                "metadata": {"path": "/var/lib/nova/instances/%i" % index},
+                # Unset fields, as common in nova and cinder records.
+                "key_name": None,
+                "task_state": generator.choice([None, "deleting"]),
+                "locked_by": None,
+                "fault": None
+            }
+        })
+    return messages
+
+
+def _measure_serializer(backend, messages):
+    """Serialise messages, then write them to a Dump; a table row.
+
+    The Dump uses gzip at level 1, so that compression does not swamp
+    the serializer's share of the time.
+    """
+    start = time.time()
+    output = [backend.dumps(message) for message in messages]
+    serialize_time = max(time.time() - start, 1e-6)
+    size = sum(len(data) for data in output)
+
+    identical = all(data == serializer.get("json").dumps(message)
+                    for data, message in zip(output, messages))
+
+    serializer.configure(backend.name)
+    dump = Dump(codecs.get("gzip"), 1)
+    start = time.time()
+    for message in messages:
+        dump.write(message)
+    dump.finish()
+    dump_time = max(time.time() - start, 1e-6)
+
+    return [backend.name, "yes" if identical else "no",
+            "%.1f" % (size / MEGABYTE),
+            "%.0f" % (len(messages) / serialize_time),
+            "%.1f" % (size / MEGABYTE / serialize_time),
+            "%.0f" % (len(messages) / dump_time)]
+
+
+def _benchmark_serializers(args):
+    """Compare serializer backends on synthetic messages."""
+    messages = _synthetic(args.messages)
+    configured = serializer.current()
+    try:
+        records = [_measure_serializer(serializer.get(name), messages)
+                   for name in sorted(serializer.BACKENDS)]
+    finally:
+        serializer.configure(configured.name)
+
+    print("%i synthetic messages" % len(messages))
+    print(tabulate(records, headers=SERIALIZER_HEADING))
+
+
+def _measure(codec, level, raw):
+    """Compress and decompress raw bytes, returning a table row."""
+    start = time.time()
+    compressed = codec.compress(raw, level)
+    compress_time = time.time() - start
+
+    start = time.time()
+    codec.decompress(compressed)
+    decompress_time = time.time() - start
+
+    return [codec.name, level,
+            "%.1f" % (len(raw) / MEGABYTE),
+            "%.1f" % (len(compressed) / MEGABYTE),
+            "%.2f" % (float(len(raw)) / len(compressed)),
+            "%.1f" % (len(raw) / MEGABYTE / max(compress_time, 1e-6)),
+            "%.1f" % (len(raw) / MEGABYTE / max(decompress_time, 1e-6))]
+
+
+def execute(args):
+    """Benchmark execution."""
+    if args.serializers:
+        _benchmark_serializers(args)
+        return
+
+    if args.topic is None:
+        sys.exit("--topic is required unless --serializers is given")
+
+    missing_environment = [
+        var for var in (REQUIRED_ENVIRONMENT_REPORTING)
+        if var not in os.environ
+    ]
+
+    if len(missing_environment) > 0:
+        sys.exit("Missing environment variables: %s" %
+                 " ".join(missing_environment))
+
+    try:
+        selected = [codecs.parse(spec) for spec in (
+            args.codec if args.codec else sorted(codecs.CODECS))]
+    except ValueError as error:
+        sys.exit(str(error))
+
+    api_config = {
+        "server": os.getenv("REPORTING_SERVER"),
+        "username": os.getenv("REPORTING_USERNAME"),
+        "token": os.getenv("REPORTING_TOKEN"),
+        "https_verify": not args.insecure
+    }
+
+    kafka = api.API(**api_config)
+
+    offset = args.offset
+    if offset is None:
+        offset = kafka.partitions(args.topic)[str(args.partition)][
+            "earliestOffset"]
+
+    messages = _sample(kafka, args.topic, args.partition, offset,
+                       args.batches)
+    if len(messages) == 0:
+        sys.exit("No messages to sample.")
+
+    # The same JSON array that archive.Dump writes.
+    raw = b"[" + b",".join(serializer.dumps(message)
+                           for message in messages) + b"]"
+
+    records = []
+    for codec, level in selected:
+        level = level if level is not None else codec.level
+        records.append(_measure(codec, level, raw))
+
+    print("%i messages sampled from %s/%i @ %i" % (
+        len(messages), args.topic, args.partition, offset))
+    print(tabulate(records, headers=HEADING))
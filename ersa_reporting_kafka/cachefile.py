@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Files kept between runs under ~/.cache/ersa-kr.
+"""
+
+import json
+import os
+
+
+def cache_path(kind, name, extension=".json"):
+    """Path of the `kind` cache file for `name` (e.g. a server or topic)."""
+    return os.path.join(os.path.expanduser("~"), ".cache", "ersa-kr",
+                        "%s-%s%s" % (kind, name.replace("/", "_"), extension))
+
+
+def load_json(path):
+    """Content of a JSON cache file; None if it is missing or corrupt."""
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_json(path, content):
+    """Write content to a JSON cache file atomically.
+
+    The file is written under a temporary name and renamed into place, so
+    readers (including other processes) see the old content or the new.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temporary = "%s.%i.tmp" % (path, os.getpid())
+    with open(temporary, "w") as handle:
+        json.dump(content, handle)
+    os.rename(temporary, path)
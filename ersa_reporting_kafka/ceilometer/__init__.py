@@ -1 +1,85 @@
 #!/usr/bin/env python
+"""
+Time slicing and resumable progress for ceilometer backfills.
+"""
+
+import json
+import os
+import threading
+
+# Bounds on the seconds covered by one ceilometer query.
+MIN_SLICE = 60
+MAX_SLICE = 24 * 60 * 60
+
+# Samples a slice should hold once its size has adapted to the data.
+TARGET_SAMPLES = 50000
+
+
+class Progress:
+    """Completed [start, end) time slices, journalled to a local file.
+
+    Each completed slice is appended as one JSON line and fsync'ed, so a
+    re-run skips every slice already uploaded, whatever its slicing.
+    Without a path, progress is kept in memory only.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = []
+        if path and os.path.exists(path):
+            with open(path) as handle:
+                for line in handle:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.completed.append((entry["start"], entry["end"]))
+
+    def record(self, start, end, samples):
+        """Mark [start, end) as uploaded."""
+        with self.lock:
+            self.completed.append((start, end))
+            if self.path:
+                with open(self.path, "a") as handle:
+                    handle.write(json.dumps({"start": start, "end": end,
+                                             "samples": samples}) + "\n")
+                    handle.flush()
+                    os.fsync(handle.fileno())
+
+    def gap(self, start, end):
+        """First [from, to) within [start, end) not yet completed, or None."""
+        with self.lock:
+            completed = sorted(self.completed)
+        for done_start, done_end in completed:
+            if done_end <= start:
+                continue
+            if done_start > start:
+                return start, min(done_start, end)
+            start = max(start, done_end)
+            if start >= end:
+                return None
+        if start >= end:
+            return None
+        return start, end
+
+
+class Slicer:
+    """Adapt slice length so slices hold about `target` samples."""
+
+    def __init__(self, size, target=TARGET_SAMPLES, minimum=MIN_SLICE,
+                 maximum=MAX_SLICE):
+        self.lock = threading.Lock()
+        self.size = size
+        self.target = target
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def observe(self, seconds, samples):
+        """Resize from a completed slice of `seconds` holding `samples`."""
+        with self.lock:
+            if samples == 0:
+                size = self.size * 2
+            else:
+                size = seconds * self.target / float(samples)
+            self.size = max(self.minimum, min(self.maximum, size))
@@ -5,16 +5,19 @@ ceilometer -> reporting
 
 # pylint: disable=import-self,protected-access
 
+import itertools
+import logging
 import os
 import sys
+import threading
 import time
 
-from functools import partial
 from multiprocessing.pool import ThreadPool
 
 from .. import REQUIRED_ENVIRONMENT_REPORTING
 from .. import REQUIRED_ENVIRONMENT_OPENSTACK
 from .. import api
+from . import Progress, Slicer
 
 import arrow
 
@@ -27,6 +30,11 @@ SCHEMA = COMMAND
 
 PAGE_SIZE = 2500
 
+THREADS = 4
+
+# Seconds of samples in the first ceilometer query; later queries adapt.
+WINDOW = 600
+
 
 def setup(subparser):
     """ceilometer CLI setup."""
@@ -35,6 +43,35 @@ def setup(subparser):
                            help="kafka-reporting topic")
     subparser.add_argument("--start", required=True, help="Start timestamp")
     subparser.add_argument("--end", required=True, help="End timestamp")
+    subparser.add_argument("--window",
+                           type=int,
+                           default=WINDOW,
+                           help="initial seconds of samples per ceilometer "
+                           "query; adapts to sample density "
+                           "(default %i)" % WINDOW)
+    subparser.add_argument("--parallel",
+                           type=int,
+                           default=1,
+                           help="time slices queried concurrently "
+                           "(default 1)")
+    subparser.add_argument("--progress",
+                           help="file recording completed time slices; "
+                           "a re-run skips them")
+    subparser.add_argument("--threads",
+                           type=int,
+                           default=THREADS,
+                           help="concurrent uploads (default %i)" % THREADS)
+    subparser.add_argument("--batch-bytes",
+                           type=int,
+                           default=api.MAX_BATCH_BYTES,
+                           help="maximum bytes per upload request "
+                           "(default %i)" % api.MAX_BATCH_BYTES)
+    subparser.add_argument("--batch-messages",
+                           type=int,
+                           default=api.MAX_BATCH_MESSAGES,
+                           help="maximum messages (of %i samples) per upload "
+                           "request (default %i)" % (PAGE_SIZE,
+                                                     api.MAX_BATCH_MESSAGES))
 
 
 def _parse_timestamp(timestamp):
@@ -54,14 +91,96 @@ def _parse_timestamp(timestamp):
 
 
 def _chunks(data, chunk_size):
-    """Break a list into chunks of size n."""
-    for i in range(0, len(data), chunk_size):
-        yield data[i:i + chunk_size]
+    """Break an iterable into lists of size n, consuming it lazily."""
+    data = iter(data)
+    while True:
+        chunk = list(itertools.islice(data, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _samples(ceilometer, start, end, inclusive):
+    """Yield samples in [start, end) (or [start, end]) as dicts."""
+    query = [
+        {"field": "timestamp",
+         "op": "ge",
+         "value": arrow.get(start)},
+        {"field": "timestamp",
+         "op": "le" if inclusive else "lt",
+         "value": arrow.get(end)}
+    ]
+    for sample in ceilometer.new_samples.list(q=query):
+        yield sample.to_dict()
+
+
+def _upload_slice(ceilometer, kafka, args, time_slice):
+    """Query one time slice and upload its samples; return sample count."""
+    start, end, inclusive = time_slice
+    count = [0]
+
+    def counted(samples):
+        """Count samples as they pass."""
+        for sample in samples:
+            count[0] += 1
+            yield sample
 
+    samples = counted(_samples(ceilometer, start, end, inclusive))
+    kafka.put_many(args.topic, SCHEMA,
+                   ({"samples": chunk}
+                    for chunk in _chunks(samples, PAGE_SIZE)),
+                   threads=args.threads,
+                   max_bytes=args.batch_bytes,
+                   max_messages=args.batch_messages)
+    return count[0]
 
-def _upload(samples, kafka, topic):
-    """kafka upload function."""
-    kafka.put(topic, SCHEMA, {"samples": samples})
+
+def _backfill(ceilometer, kafka, args, start, end):
+    """Upload [start, end] in time slices, `args.parallel` at a time.
+
+    Slices already recorded in the progress file are skipped, and each
+    slice is recorded once all of its samples are uploaded. Slice length
+    adapts to sample density. Returns the number of failed slices.
+    """
+    progress = Progress(args.progress)
+    slicer = Slicer(args.window)
+    pool = ThreadPool(args.parallel)
+    slots = threading.BoundedSemaphore(args.parallel)
+    failed = []
+
+    def run(time_slice):
+        """Upload a slice, recording success and adapting the slicer."""
+        try:
+            samples = _upload_slice(ceilometer, kafka, args, time_slice)
+            slicer.observe(time_slice[1] - time_slice[0], samples)
+            progress.record(time_slice[0], time_slice[1], samples)
+            logging.info("ceilometer slice %s - %s: %i samples",
+                         arrow.get(time_slice[0]), arrow.get(time_slice[1]),
+                         samples)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("ceilometer slice %s - %s failed",
+                              arrow.get(time_slice[0]),
+                              arrow.get(time_slice[1]))
+            failed.append(time_slice)
+        finally:
+            slots.release()
+
+    # Slices are [from, to) except the last, which includes the end.
+    cursor = start
+    try:
+        while True:
+            gap = progress.gap(cursor, end)
+            if gap is None:
+                break
+            slots.acquire()
+            slice_end = min(gap[0] + slicer.size, gap[1])
+            pool.apply_async(run, ((gap[0], slice_end, slice_end == end),))
+            cursor = slice_end
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+    return len(failed)
 
 
 def execute(args):
@@ -92,20 +211,11 @@ def execute(args):
                                    os_password=os.getenv("OS_PASSWORD"),
                                    os_tenant_name=os.getenv("OS_TENANT_NAME"))
 
-    query = [
-        {"field": "timestamp",
-         "op": "ge",
-         "value": start_timestamp},
-        {"field": "timestamp",
-         "op": "le",
-         "value": end_timestamp}
-    ]
-
-    result = [sample.to_dict()
-              for sample in ceilometer.new_samples.list(q=query)]
-
-    result_chunks = list(_chunks(result, PAGE_SIZE))
-
     kafka = api.API(**api_config)
-    kafka_upload = partial(_upload, kafka=kafka, topic=args.topic)
-    ThreadPool().map(kafka_upload, result_chunks, 1)
+
+    failures = _backfill(ceilometer, kafka, args,
+                         start_timestamp.float_timestamp,
+                         end_timestamp.float_timestamp)
+    if failures > 0:
+        sys.exit("%i time slices failed; re-run with the same --progress "
+                 "file to retry them" % failures)
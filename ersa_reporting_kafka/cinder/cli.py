@@ -5,6 +5,7 @@ cinder -> reporting
 
 # pylint: disable=import-self,protected-access
 
+import logging
 import os
 import sys
 import uuid
@@ -12,6 +13,8 @@ import uuid
 from .. import REQUIRED_ENVIRONMENT_REPORTING
 from .. import REQUIRED_ENVIRONMENT_OPENSTACK
 from .. import api
+from ..delta import DeltaCache, default_path, publish
+from ..pipeline import Prefetch, Stopwatch
 
 from keystoneclient.auth.identity import v2
 from keystoneclient import session
@@ -24,12 +27,27 @@ SCHEMA = COMMAND
 
 PAGE_SIZE = 1000
 
+# Pages fetched from OpenStack while earlier ones are being uploaded.
+PREFETCH = 2
+
 
 def setup(subparser):
     """cinder CLI setup."""
     subparser.add_argument("--topic",
                            required=True,
                            help="kafka-reporting topic")
+    subparser.add_argument("--prefetch",
+                           type=int,
+                           default=PREFETCH,
+                           help="pages to fetch ahead of uploading "
+                           "(default %i)" % PREFETCH)
+    subparser.add_argument("--delta",
+                           action="store_true",
+                           help="publish only volumes added, changed or "
+                           "removed since the last --delta run")
+    subparser.add_argument("--delta-cache",
+                           help="state of the last --delta run (default "
+                           "~/.cache/ersa-kr/delta-%s-TOPIC.json)" % COMMAND)
 
 
 def _volumes(cinder, marker=None):
@@ -39,6 +57,14 @@ def _volumes(cinder, marker=None):
                                limit=PAGE_SIZE)
 
 
+def _pages(cinder):
+    """Volumes, one page of dicts at a time."""
+    volumes = _volumes(cinder)
+    while len(volumes) > 0:
+        yield [volume._info for volume in volumes]
+        volumes = _volumes(cinder, marker=volumes[-1].id)
+
+
 def execute(args):
     """cinder execution."""
     missing_environment = [
@@ -69,14 +95,26 @@ def execute(args):
 
     snapshot = str(uuid.uuid4())
 
-    volumes = _volumes(cinder)
-
-    while len(volumes) > 0:
-        payload = {
-            "snapshot": snapshot,
-            "volumes": [volume._info for volume in volumes]
-        }
-
-        kafka.put(args.topic, SCHEMA, payload)
-
-        volumes = _volumes(cinder, marker=volumes[-1].id)
+    # Pages are fetched by a background thread while earlier ones upload.
+    fetching, waiting = Stopwatch(), Stopwatch()
+    pages = Prefetch(fetching.timed(_pages(cinder)), args.prefetch)
+    try:
+        if args.delta:
+            cache = DeltaCache(args.delta_cache if args.delta_cache else
+                               default_path("%s-%s" % (COMMAND, args.topic)))
+            publish(kafka, args.topic, SCHEMA, snapshot, "volumes",
+                    waiting.timed(pages), cache, PAGE_SIZE)
+        else:
+            for volumes in waiting.timed(pages):
+                payload = {
+                    "snapshot": snapshot,
+                    "volumes": volumes
+                }
+
+                kafka.put(args.topic, SCHEMA, payload)
+    finally:
+        pages.close()
+
+    logging.info("%s: fetching %.1fs, uploading %.1fs, total %.1fs",
+                 COMMAND, fetching.seconds,
+                 fetching.elapsed() - waiting.seconds, fetching.elapsed())
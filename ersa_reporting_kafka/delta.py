@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Change-only snapshots: publish only resources added, changed or removed
+since the last published state.
+"""
+
+import hashlib
+import json
+
+from .cachefile import cache_path, load_json, save_json
+
+
+def default_path(name):
+    """Per-producer cache file under ~/.cache/ersa-kr."""
+    return cache_path("delta", name)
+
+
+def digest(resource):
+    """Content hash of a resource, independent of key order."""
+    return hashlib.sha1(json.dumps(resource, sort_keys=True).encode(
+        "utf-8")).hexdigest()
+
+
+class DeltaCache:
+    """Content hashes of the last published state, by resource id.
+
+    The new state replaces the old one only when saved, so a failed run
+    publishes its changes again next time.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.published = {}
+        self.seen = {}
+        self.load()
+
+    def load(self):
+        """Read the cache file; a missing or corrupt file is an empty cache."""
+        content = load_json(self.path)
+        self.published = content.get("resources", {}) if content else {}
+
+    def changed(self, resources):
+        """Return the resources added or changed since last published."""
+        changes = []
+        for resource in resources:
+            resource_id = str(resource["id"])
+            resource_digest = digest(resource)
+            self.seen[resource_id] = resource_digest
+            if self.published.get(resource_id) != resource_digest:
+                changes.append(resource)
+        return changes
+
+    def removed(self):
+        """Return the ids published before but not seen in this run."""
+        return sorted(set(self.published) - set(self.seen))
+
+    def save(self):
+        """Make this run's state the published one, atomically."""
+        save_json(self.path, {"resources": self.seen})
+        self.published, self.seen = self.seen, {}
+
+
+def publish(kafka, topic, schema, snapshot, key, pages, cache,
+            page_size=1000, first=None):
+    """Publish the changes within pages of resources as a delta snapshot.
+
+    Changed resources are sent under `key`, `page_size` to a message;
+    `first` (e.g. flavors) goes in the first message only and the ids of
+    removed resources in the last one. Every message is marked "delta", and
+    at least one is sent, so consumers see each snapshot. The cache is
+    saved once everything is published. Returns the number of changes.
+    """
+    pending = []
+    state = {"first": first or {}, "changes": 0}
+
+    def send(resources, removed=None):
+        """Put one delta message."""
+        payload = {"snapshot": snapshot, "delta": True, key: resources}
+        payload.update(state["first"])
+        state["first"] = {}
+        if removed is not None:
+            payload["removed"] = removed
+        kafka.put(topic, schema, payload)
+        state["changes"] += len(resources)
+
+    for page in pages:
+        pending.extend(cache.changed(page))
+        while len(pending) >= page_size:
+            send(pending[:page_size])
+            pending = pending[page_size:]
+
+    removed = cache.removed()
+    send(pending, removed)
+    cache.save()
+    return state["changes"] + len(removed)
@@ -6,17 +6,40 @@ Message retrieval.
 
 # pylint: disable=import-self
 
+import argparse
+import itertools
 import json
 import sys
 import os
+import time
 
 from .. import REQUIRED_ENVIRONMENT_REPORTING, api
+from ..api.index import OffsetIndex, default_path
 
 COMMAND = "get"
 DESCRIPTION = "Retrieve [batch size] of messages @ (topic, partition, offset)."
 
 SCHEMA = COMMAND
 
+LATEST = "latest"
+
+# Seconds between flushes of stdout while messages are written.
+FLUSH_INTERVAL = 0.5
+
+
+def _offset(value):
+    """Parse an offset, or None for "latest"."""
+    return None if value == LATEST else int(value)
+
+
+def _until(value):
+    """Validate --until: an offset, "latest" or an ISO 8601 time."""
+    try:
+        _offset(value)
+    except ValueError:
+        api.parse_time(value)
+    return value
+
 
 def setup(subparser):
     """Get CLI setup."""
@@ -24,18 +47,93 @@ def setup(subparser):
                            required=True,
                            help="kafka-reporting topic")
     subparser.add_argument("--partition",
-                           required=True,
                            type=int,
-                           help="kafka-reporting partition")
+                           help="kafka-reporting partition (default: stream "
+                           "all partitions as newline-delimited JSON)")
     subparser.add_argument(
         "--offset",
-        required=True,
         type=int,
-        help="kafka-reporting offset (negative → relative to most recent)")
+        help="kafka-reporting offset (negative → relative to most recent); "
+        "required with --partition, else the start offset in every "
+        "partition (default: earliest)")
     subparser.add_argument(
         "--pretty",
         help="Pretty-print JSON.",
         action="store_true")
+    subparser.add_argument(
+        "--until",
+        type=_until,
+        default=argparse.SUPPRESS,
+        help="Stream messages up to this offset or ISO 8601 time "
+        "(exclusive), or \"%s\", as newline-delimited JSON." % LATEST)
+    subparser.add_argument(
+        "--since",
+        type=api.parse_time,
+        help="Stream messages from this ISO 8601 time (instead of --offset) "
+        "as newline-delimited JSON.")
+    subparser.add_argument(
+        "--count",
+        type=int,
+        help="Stream at most this many messages as newline-delimited JSON.")
+    subparser.add_argument(
+        "--ordered",
+        help="With all partitions, merge messages in timestamp order "
+        "instead of writing them as they arrive.",
+        action="store_true")
+
+
+def _write(messages, count=None):
+    """Write messages to stdout as newline-delimited JSON, as they arrive.
+
+    Output is flushed every FLUSH_INTERVAL seconds rather than after each
+    message, and once more at the end.
+    """
+    flushed = time.time()
+    try:
+        for message in itertools.islice(messages, count):
+            sys.stdout.write(json.dumps(message) + "\n")
+            if time.time() - flushed >= FLUSH_INTERVAL:
+                sys.stdout.flush()
+                flushed = time.time()
+    finally:
+        sys.stdout.flush()
+        messages.close()
+
+
+def _ranges(kafka, args):
+    """Offset range to stream from each selected partition of the topic.
+
+    Times are turned into offsets by seeking, with the probes cached in
+    the on-disk offset index. Without --until, a single partition is
+    streamed up to its latest offset at the time, and all partitions up to
+    their latest offsets at the start.
+    """
+    ranges = kafka.ranges(args.topic)
+    if args.partition is not None:
+        if args.partition not in ranges:
+            sys.exit("No partition %i in %s" % (args.partition, args.topic))
+        ranges = {args.partition: ranges[args.partition]}
+        if "until" not in args:
+            args.until = LATEST
+
+    index = OffsetIndex(default_path(kafka.server))
+    for partition, (earliest, latest) in ranges.items():
+        start, end = earliest, latest
+        if args.offset is not None:
+            start = args.offset
+        elif args.since is not None:
+            start = kafka.seek(args.topic, partition, args.since, index,
+                               (earliest, latest))
+        if "until" in args:
+            try:
+                end = _offset(args.until)
+            except ValueError:
+                end = kafka.seek(args.topic, partition,
+                                 api.parse_time(args.until), index,
+                                 (earliest, latest))
+        ranges[partition] = (start, end)
+    index.save()
+    return ranges
 
 
 def execute(args):
@@ -56,8 +154,23 @@ def execute(args):
         "https_verify": not args.insecure
     }
 
-    data, _ = api.API(**api_config).get(args.topic, args.partition,
-                                        args.offset)
+    kafka = api.API(**api_config)
+
+    streaming = (args.partition is None or "until" in args or
+                 args.since is not None or args.count is not None)
+    if streaming and args.pretty:
+        sys.exit("--pretty cannot be used when streaming messages")
+
+    if args.partition is not None and args.offset is None and \
+            args.since is None:
+        sys.exit("--offset or --since is required with --partition")
+
+    if streaming:
+        _write(kafka.iter_topic(args.topic, _ranges(kafka, args),
+                                ordered=args.ordered), args.count)
+        return
+
+    data, _ = kafka.get(args.topic, args.partition, args.offset)
 
     if data:
         if args.pretty:
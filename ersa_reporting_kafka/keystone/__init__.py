@@ -1 +1,69 @@
 #!/usr/bin/env python
+"""
+Cache of keystone tenant memberships.
+"""
+
+import threading
+import time
+
+from ..cachefile import cache_path, load_json, save_json
+from ..delta import digest
+
+# Seconds for which a tenant's cached user list is reused; by default it
+# is not (see MembershipCache).
+TTL = 0
+
+
+def default_path(topic):
+    """Per-topic cache file under ~/.cache/ersa-kr."""
+    return cache_path("keystone-members", topic)
+
+
+class MembershipCache:
+    """User lists of tenants from earlier runs, by tenant id.
+
+    A cached list is reused while the tenant itself is unchanged (same
+    content hash) and the list is younger than `ttl` seconds. Users added
+    to or removed from a tenant do not change the tenant itself, so a
+    reused list may be up to `ttl` seconds out of date. Only the tenants
+    seen in this run are kept when saving.
+    """
+
+    def __init__(self, path, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cached = {}
+        self.current = {}
+        self.load()
+
+    def load(self):
+        """Read the cache file; a missing or corrupt file is an empty cache."""
+        content = load_json(self.path)
+        self.cached = content.get("tenants", {}) if content else {}
+
+    def users(self, tenant_info):
+        """Return the tenant's cached user ids, or None if stale/unknown."""
+        tenant_id = str(tenant_info["id"])
+        with self.lock:
+            entry = self.cached.get(tenant_id)
+            if entry is None or entry["digest"] != digest(tenant_info) or \
+                    time.time() - entry["fetched"] >= self.ttl:
+                return None
+            self.current[tenant_id] = entry
+            return entry["users"]
+
+    def record(self, tenant_info, users):
+        """Remember user ids just fetched for a tenant."""
+        with self.lock:
+            self.current[str(tenant_info["id"])] = {
+                "digest": digest(tenant_info),
+                "users": users,
+                "fetched": time.time()
+            }
+
+    def save(self):
+        """Write the tenants seen in this run, atomically."""
+        with self.lock:
+            current = dict(self.current)
+        save_json(self.path, {"tenants": current})
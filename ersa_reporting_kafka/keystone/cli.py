@@ -5,15 +5,19 @@ keystone -> reporting
 
 # pylint: disable=broad-except,import-self,protected-access
 
+import itertools
+import logging
 import os
 import sys
 import time
+import uuid
 
-from multiprocessing.pool import ThreadPool
+from functools import partial
 
 from .. import REQUIRED_ENVIRONMENT_REPORTING
 from .. import REQUIRED_ENVIRONMENT_OPENSTACK
 from .. import api
+from . import MembershipCache, TTL, default_path
 
 from keystoneclient.auth.identity import v2
 from keystoneclient.v2_0 import client
@@ -24,35 +28,101 @@ DESCRIPTION = "Producer: keystone users, tenants and memberships."
 
 SCHEMA = COMMAND
 
+# Concurrent membership requests to keystone.
+THREADS = 8
+
+# Seconds before a keystone request is abandoned (and retried).
+TIMEOUT = 30
+
+# Attempts at fetching one tenant's membership.
+ATTEMPTS = 3
+
+# Users or tenants per message.
+CHUNK_SIZE = 500
+
 
 def setup(subparser):
     """keystone CLI setup."""
     subparser.add_argument("--topic",
                            required=True,
                            help="kafka-reporting topic")
-
-
-def process(tenant):
-    """Populate tenants."""
+    subparser.add_argument("--threads",
+                           type=int,
+                           default=THREADS,
+                           help="concurrent membership requests "
+                           "(default %i)" % THREADS)
+    subparser.add_argument("--timeout",
+                           type=float,
+                           default=TIMEOUT,
+                           help="seconds allowed per keystone request "
+                           "(default %i)" % TIMEOUT)
+    subparser.add_argument("--chunk-size",
+                           type=int,
+                           default=CHUNK_SIZE,
+                           help="users or tenants per message "
+                           "(default %i)" % CHUNK_SIZE)
+    subparser.add_argument("--membership-cache",
+                           help="tenant membership cache (default "
+                           "~/.cache/ersa-kr/keystone-members-TOPIC.json)")
+    subparser.add_argument("--membership-ttl",
+                           type=int,
+                           default=TTL,
+                           help="seconds to reuse the cached membership of "
+                           "an unchanged tenant, which misses users added "
+                           "or removed meanwhile; 0 to always fetch "
+                           "(default %i)" % TTL)
+
+
+def process(tenant, cache=None):
+    """Populate tenants.
+
+    Membership comes from `cache` (a MembershipCache) when it has a fresh
+    entry; otherwise it is fetched, with retries. A tenant whose membership
+    cannot be fetched is returned without "users".
+    """
     tenant_info = tenant._info
     if tenant_info[
             "description"
     ] and "personal tenancy" not in tenant_info["description"].lower():
-        membership_retrieved = False
+        users = cache.users(tenant_info) if cache else None
         membership_attempt = 0
-        while not membership_retrieved and membership_attempt < 3:
+        while users is None and membership_attempt < ATTEMPTS:
             try:
-                tenant_info["users"] = [
-                    user.id for user in tenant.list_users()
-                ]
-                membership_retrieved = True
+                users = [user.id for user in tenant.list_users()]
+                if cache:
+                    cache.record(tenant_info, users)
             except Exception as exception:
-                print(exception)
+                logging.warning("tenant %s membership: %s (attempt %i)",
+                                tenant_info["id"], exception,
+                                membership_attempt + 1)
                 time.sleep(2 ** membership_attempt)
                 membership_attempt += 1
+        if users is None:
+            logging.error("tenant %s membership: giving up",
+                          tenant_info["id"])
+        else:
+            tenant_info["users"] = users
     return tenant_info
 
 
+def _chunks(items, size):
+    """Split an iterable into lists of up to size items, lazily."""
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _payloads(snapshot, users, tenants, size):
+    """Messages of one snapshot: chunks of users, then chunks of tenants."""
+    for chunk in _chunks(users, size):
+        yield {"snapshot": snapshot, "users": chunk}
+    for chunk in _chunks(tenants, size):
+        yield {"snapshot": snapshot, "tenants": chunk}
+
+
 def execute(args):
     """keystone execution."""
     missing_environment = [
@@ -76,15 +146,31 @@ def execute(args):
                        username=os.getenv("OS_USERNAME"),
                        password=os.getenv("OS_PASSWORD"),
                        tenant_name=os.getenv("OS_TENANT_NAME"))
-    keystone_session = session.Session(auth=auth)
+    keystone_session = session.Session(auth=auth, timeout=args.timeout)
     keystone = client.Client(session=keystone_session)
 
     kafka = api.API(**api_config)
 
-    users = [user._info for user in keystone.users.list()]
-
-    tenants = ThreadPool().map(process, keystone.tenants.list())
+    cache = None
+    if args.membership_ttl > 0:
+        cache = MembershipCache(
+            args.membership_cache if args.membership_cache else
+            default_path(args.topic), args.membership_ttl)
 
-    payload = {"users": users, "tenants": tenants}
+    users = [user._info for user in keystone.users.list()]
 
-    kafka.put(args.topic, SCHEMA, payload)
+    # Tenants are put in chunks as their memberships come in.
+    tenants = api.shared_executor().imap_unordered(
+        partial(process, cache=cache), keystone.tenants.list(),
+        args.threads)
+
+    if args.chunk_size > 0:
+        kafka.put_many(args.topic, SCHEMA,
+                       _payloads(str(uuid.uuid4()), users, tenants,
+                                 args.chunk_size))
+    else:
+        kafka.put(args.topic, SCHEMA,
+                  {"users": users, "tenants": list(tenants)})
+
+    if cache:
+        cache.save()
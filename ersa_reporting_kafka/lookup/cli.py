@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Find archived objects by time or offset, from the archive manifests alone.
+"""
+
+# pylint: disable=import-error,import-self
+
+import sys
+import os
+
+import arrow
+
+from tabulate import tabulate
+
+from .. import REQUIRED_ENVIRONMENT_AWS, api
+from ..archive import Archive, covering
+
+COMMAND = "lookup"
+DESCRIPTION = "Find archived objects covering a time window or offset."
+
+HEADING = ["Object", "Offsets", "Messages", "Earliest", "Latest", "Stored"]
+
+
+def setup(subparser):
+    """Lookup CLI setup."""
+    subparser.add_argument("--topic",
+                           required=True,
+                           nargs="+",
+                           help="kafka-reporting topic(s)")
+    subparser.add_argument("--partition",
+                           type=int,
+                           nargs="+",
+                           help="kafka-reporting partition(s) "
+                           "(default all archived partitions)")
+    subparser.add_argument("--namespace",
+                           required=True,
+                           help="AWS namespace")
+    subparser.add_argument("--prefix",
+                           default="",
+                           help="object prefix (default '')")
+    subparser.add_argument("--since",
+                           type=api.parse_time,
+                           help="objects holding messages at or after this "
+                           "ISO 8601 time")
+    subparser.add_argument("--until",
+                           type=api.parse_time,
+                           help="objects holding messages before this "
+                           "ISO 8601 time")
+    subparser.add_argument("--offset",
+                           type=int,
+                           help="the object holding this offset")
+    subparser.add_argument("--names",
+                           action="store_true",
+                           help="print object names only, one per line")
+
+
+def _printable(timestamp):
+    """Generate a printable timestamp (milliseconds) string."""
+    if timestamp is None:
+        return "-"
+    return arrow.get(timestamp / 1000.0).isoformat()
+
+
+def _record(entry):
+    """One table row for a manifest entry."""
+    return [entry["object"], "%i-%i" % (entry["start"], entry["end"]),
+            "-" if entry["messages"] is None else
+            "{:,}".format(entry["messages"]),
+            _printable(entry["earliest_timestamp"]),
+            _printable(entry["latest_timestamp"]),
+            "{:,}".format(entry["stored_bytes"])]
+
+
+def execute(args):
+    """Lookup execution."""
+    missing_environment = [
+        var for var in (REQUIRED_ENVIRONMENT_AWS)
+        if var not in os.environ
+    ]
+
+    if len(missing_environment) > 0:
+        sys.exit("Missing environment variables: %s" %
+                 " ".join(missing_environment))
+
+    archive = Archive(os.getenv("OS_AWS_ID"),
+                      os.getenv("OS_AWS_SECRET"),
+                      os.getenv("OS_AWS_URL"),
+                      args.namespace,
+                      args.prefix)
+
+    entries = []
+    for topic in args.topic:
+        partitions = args.partition or archive.partitions(topic)
+        for partition in partitions:
+            entries.extend(covering(archive.manifest(topic, partition),
+                                    args.since, args.until, args.offset))
+
+    if args.names:
+        for entry in entries:
+            print(entry["object"])
+    else:
+        print(tabulate([_record(entry) for entry in entries],
+                       headers=HEADING))
@@ -5,6 +5,7 @@ nova -> reporting
 
 # pylint: disable=import-self,protected-access
 
+import logging
 import os
 import sys
 import uuid
@@ -12,6 +13,8 @@ import uuid
 from .. import REQUIRED_ENVIRONMENT_REPORTING
 from .. import REQUIRED_ENVIRONMENT_OPENSTACK
 from .. import api
+from ..delta import DeltaCache, default_path, publish
+from ..pipeline import Prefetch, Stopwatch
 
 from keystoneclient.auth.identity import v2
 from keystoneclient import session
@@ -24,12 +27,27 @@ SCHEMA = COMMAND
 
 PAGE_SIZE = 1000
 
+# Pages fetched from OpenStack while earlier ones are being uploaded.
+PREFETCH = 2
+
 
 def setup(subparser):
     """nova CLI setup."""
     subparser.add_argument("--topic",
                            required=True,
                            help="kafka-reporting topic")
+    subparser.add_argument("--prefetch",
+                           type=int,
+                           default=PREFETCH,
+                           help="pages to fetch ahead of uploading "
+                           "(default %i)" % PREFETCH)
+    subparser.add_argument("--delta",
+                           action="store_true",
+                           help="publish only instances added, changed or "
+                           "removed since the last --delta run")
+    subparser.add_argument("--delta-cache",
+                           help="state of the last --delta run (default "
+                           "~/.cache/ersa-kr/delta-%s-TOPIC.json)" % COMMAND)
 
 
 def _instances(nova, marker=None):
@@ -44,6 +62,14 @@ def _flavors(nova):
     return nova.flavors.list(is_public=None)
 
 
+def _pages(nova):
+    """Instances, one page of dicts at a time."""
+    instances = _instances(nova)
+    while len(instances) > 0:
+        yield [instance._info for instance in instances]
+        instances = _instances(nova, marker=instances[-1].id)
+
+
 def execute(args):
     """nova execution."""
     missing_environment = [
@@ -76,15 +102,28 @@ def execute(args):
 
     flavors = [f._info for f in _flavors(nova)]
 
-    instances = _instances(nova)
-
-    while len(instances) > 0:
-        payload = {
-            "snapshot": snapshot,
-            "flavors": flavors,
-            "instances": [instance._info for instance in instances]
-        }
-
-        kafka.put(args.topic, SCHEMA, payload)
-
-        instances = _instances(nova, marker=instances[-1].id)
+    # Pages are fetched by a background thread while earlier ones upload.
+    fetching, waiting = Stopwatch(), Stopwatch()
+    pages = Prefetch(fetching.timed(_pages(nova)), args.prefetch)
+    try:
+        if args.delta:
+            cache = DeltaCache(args.delta_cache if args.delta_cache else
+                               default_path("%s-%s" % (COMMAND, args.topic)))
+            publish(kafka, args.topic, SCHEMA, snapshot, "instances",
+                    waiting.timed(pages), cache, PAGE_SIZE,
+                    {"flavors": flavors})
+        else:
+            for instances in waiting.timed(pages):
+                payload = {
+                    "snapshot": snapshot,
+                    "flavors": flavors,
+                    "instances": instances
+                }
+
+                kafka.put(args.topic, SCHEMA, payload)
+    finally:
+        pages.close()
+
+    logging.info("%s: fetching %.1fs, uploading %.1fs, total %.1fs",
+                 COMMAND, fetching.seconds,
+                 fetching.elapsed() - waiting.seconds, fetching.elapsed())
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+"""Background stages for overlapping network I/O with processing."""
+
+import heapq
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_DONE = object()
+
+# Seconds close() waits for producer threads to stop.
+CLOSE_TIMEOUT = 1.0
+
+
+class Prefetch:
+    """Iterate over an iterable which is driven by a background thread.
+
+    Up to `depth` items are produced ahead of the consumer. Items come out
+    in the order they were produced, and an exception raised while
+    producing is re-raised to the consumer in place of the next item.
+    """
+
+    def __init__(self, iterable, depth=4):
+        self.queue = queue.Queue(maxsize=max(depth, 1))
+        self.stopped = threading.Event()
+        self.finished = False
+        self.threads = [self._start(iterable)]
+
+    def _start(self, iterable):
+        """Start a producer thread for iterable."""
+        thread = threading.Thread(target=self._run, args=(iterable,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _put(self, entry):
+        """Queue an entry unless the consumer has gone away."""
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self, iterable):
+        """Producer loop."""
+        try:
+            for item in iterable:
+                if not self._put((item, None)):
+                    return
+        except Exception as exception:  # pylint: disable=broad-except
+            self._put((_DONE, exception))
+            return
+        self._put((_DONE, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.finished:
+            raise StopIteration
+        item, error = self.queue.get()
+        if item is _DONE:
+            self.finished = True
+            self.stopped.set()
+            if error is not None:
+                raise error
+            raise StopIteration
+        return item
+
+    next = __next__
+
+    def close(self):
+        """Stop the producers; items not yet consumed are discarded.
+
+        Producers get up to CLOSE_TIMEOUT seconds to finish, so that none
+        is still running while the interpreter shuts down.
+        """
+        self.finished = True
+        self.stopped.set()
+        deadline = time.time() + CLOSE_TIMEOUT
+        for thread in self.threads:
+            thread.join(max(deadline - time.time(), 0))
+
+
+class Stopwatch:
+    """Time accumulated by a pipeline stage."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.started = time.time()
+
+    def timed(self, iterable):
+        """Yield from iterable, adding the time taken to produce items."""
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.seconds += time.time() - start
+            yield item
+
+    def elapsed(self):
+        """Wall-clock seconds since the stopwatch was created."""
+        return time.time() - self.started
+
+
+class Interleave(Prefetch):
+    """Iterate over several iterables at once, each driven by its own thread.
+
+    Items come out in the order they were produced, whichever iterable
+    they came from; up to `depth` items per iterable are produced ahead of
+    the consumer. The first exception raised by any producer is re-raised
+    to the consumer, and stops the others.
+    """
+
+    # pylint: disable=super-init-not-called
+    def __init__(self, iterables, depth=4):
+        iterables = list(iterables)
+        self.queue = queue.Queue(
+            maxsize=max(depth, 1) * max(len(iterables), 1))
+        self.stopped = threading.Event()
+        self.running = len(iterables)
+        self.finished = self.running == 0
+        self.threads = [self._start(iterable) for iterable in iterables]
+
+    def __next__(self):
+        while not self.finished:
+            item, error = self.queue.get()
+            if item is not _DONE:
+                return item
+            self.running -= 1
+            if error is not None or self.running == 0:
+                self.finished = True
+                self.stopped.set()
+            if error is not None:
+                raise error
+        raise StopIteration
+
+    next = __next__
+
+
+def merge(iterables, key):
+    """Merge iterables, each sorted by key, into one sorted iterator.
+
+    This is a k-way merge over a heap holding the next item of each
+    iterable, so only one item per iterable is held at a time.
+    """
+    heap = []
+    for index, iterable in enumerate(iterables):
+        iterator = iter(iterable)
+        for item in iterator:
+            heap.append((key(item), index, item, iterator))
+            break
+    heapq.heapify(heap)
+
+    while heap:
+        _, index, item, iterator = heap[0]
+        yield item
+        for following in iterator:
+            heapq.heapreplace(heap, (key(following), index, following,
+                                     iterator))
+            break
+        else:
+            heapq.heappop(heap)
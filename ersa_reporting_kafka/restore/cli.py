@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+"""
+Read archived messages back from object store as newline-delimited JSON.
+"""
+
+# pylint: disable=import-self
+
+import collections
+import json
+import logging
+import shutil
+import sys
+import os
+import tempfile
+import threading
+
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+from .. import REQUIRED_ENVIRONMENT_AWS, api
+from ..archive import Archive, covering
+
+COMMAND = "restore"
+DESCRIPTION = "Read archived messages back as newline-delimited JSON."
+
+THREADS = 4
+
+# Attempts to read an object, each from the beginning.
+ATTEMPTS = 3
+
+
+def setup(subparser):
+    """Restore CLI setup."""
+    subparser.add_argument("--topic",
+                           required=True,
+                           nargs="+",
+                           help="kafka-reporting topic(s)")
+    subparser.add_argument("--partition",
+                           type=int,
+                           nargs="+",
+                           help="kafka-reporting partition(s) "
+                           "(default all archived partitions)")
+    subparser.add_argument("--namespace",
+                           required=True,
+                           help="AWS namespace")
+    subparser.add_argument("--prefix",
+                           default="",
+                           help="object prefix (default '')")
+    subparser.add_argument("--offset",
+                           type=int,
+                           help="first offset to restore")
+    subparser.add_argument("--end-offset",
+                           type=int,
+                           help="offset to stop before")
+    subparser.add_argument("--since",
+                           type=api.parse_time,
+                           help="skip messages older than this ISO 8601 time")
+    subparser.add_argument("--until",
+                           type=api.parse_time,
+                           help="skip messages at or after this ISO 8601 "
+                           "time")
+    subparser.add_argument("--threads",
+                           type=int,
+                           default=THREADS,
+                           help="objects to fetch and decompress "
+                           "concurrently, each into a temporary file of "
+                           "its restored messages; output follows the "
+                           "oldest, so up to this many objects' worth of "
+                           "JSON is held on local disk (default %i)" %
+                           THREADS)
+
+
+def _objects(archive, args, topic, partition):
+    """(start, end, name) of the partition's objects overlapping the range.
+
+    Objects are chosen by the offsets in their names and, for objects in
+    the manifest, by their timestamps.
+    """
+    excluded = set()
+    if args.since is not None or args.until is not None:
+        entries = archive.manifest(topic, partition)
+        kept = set(entry["object"] for entry in
+                   covering(entries, args.since, args.until))
+        excluded = set(entry["object"] for entry in entries) - kept
+
+    for start, end, name in archive.objects(topic, partition):
+        if args.offset is not None and end < args.offset:
+            continue
+        if args.end_offset is not None and start >= args.end_offset:
+            continue
+        if name not in excluded:
+            yield start, end, name
+
+
+def _messages(archive, args, start, name):
+    """Yield lists of the object's messages which are in range."""
+    offset = start
+    for messages in archive.read(name):
+        selected = []
+        for message in messages:
+            if args.end_offset is not None and offset >= args.end_offset:
+                break
+            if args.offset is None or offset >= args.offset:
+                timestamp = message.get("timestamp")
+                if timestamp is None or (
+                        (args.since is None or timestamp >= args.since) and
+                        (args.until is None or timestamp < args.until)):
+                    selected.append(message)
+            offset += 1
+        if selected:
+            yield selected
+        if args.end_offset is not None and offset >= args.end_offset:
+            return
+
+
+def _spool(archive, args, start, name, stopped):
+    """Return a temporary file of the object's messages in range, rewound.
+
+    The object is read in full straight away, so its download is never
+    left idle. A failed read is retried from the beginning, up to
+    ATTEMPTS times; once `stopped` is set, reading ends early.
+    """
+    spool = tempfile.TemporaryFile("w+")
+    attempt = 1
+    try:
+        while True:
+            try:
+                for messages in _messages(archive, args, start, name):
+                    if stopped.is_set():
+                        break
+                    spool.write("".join(json.dumps(message) + "\n"
+                                        for message in messages))
+                spool.seek(0)
+                return spool
+            except (IOError, httplib.HTTPException) as exception:
+                if attempt >= ATTEMPTS:
+                    raise
+                logging.warning("%s: %s; reading it again (#%i)", name,
+                                exception, attempt)
+                spool.seek(0)
+                spool.truncate()
+                attempt += 1
+    except Exception:
+        spool.close()
+        raise
+
+
+def _restore(archive, args, objects, output):
+    """Write the objects' messages to output, object by object, in order.
+
+    Up to `--threads` objects are read at once on the shared executor,
+    each into a temporary file which is copied to output in turn.
+    """
+    objects = iter(objects)
+    window = collections.deque()
+    stopped = threading.Event()
+    executor = api.shared_executor()
+    try:
+        while True:
+            while len(window) < max(args.threads, 1):
+                try:
+                    start, _, name = next(objects)
+                except StopIteration:
+                    break
+                window.append(executor.submit(_spool, archive, args, start,
+                                              name, stopped))
+            if not window:
+                return
+            spool = window.popleft().get()
+            try:
+                shutil.copyfileobj(spool, output)
+                output.flush()
+            finally:
+                spool.close()
+    finally:
+        stopped.set()
+        for pending in window:
+            try:
+                pending.get().close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+
+
+def execute(args):
+    """Restore execution."""
+    missing_environment = [
+        var for var in (REQUIRED_ENVIRONMENT_AWS)
+        if var not in os.environ
+    ]
+
+    if len(missing_environment) > 0:
+        sys.exit("Missing environment variables: %s" %
+                 " ".join(missing_environment))
+
+    archive = Archive(os.getenv("OS_AWS_ID"),
+                      os.getenv("OS_AWS_SECRET"),
+                      os.getenv("OS_AWS_URL"),
+                      args.namespace,
+                      args.prefix)
+
+    for topic in args.topic:
+        for partition in args.partition or archive.partitions(topic):
+            objects = _objects(archive, args, topic, partition)
+            _restore(archive, args, objects, sys.stdout)
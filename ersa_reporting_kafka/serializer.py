@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+JSON serialization backends.
+
+The standard library's json is always available and is the default; orjson
+and ujson may be selected when installed. Every backend returns UTF-8
+encoded bytes, and a backend is only offered if it writes every value so
+that it reads back unchanged.
+"""
+
+# pylint: disable=import-error,too-few-public-methods
+
+import json
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+BACKENDS = {}
+
+DEFAULT = "json"
+
+# Values which lossy encoders have been seen to change: ujson 1.x rounds
+# floats to 10 significant digits, for example.
+PROBE = [0.1 + 0.2, 1 / 3.0, 1e-12, 2 ** -1074, 1.7976931348623157e308,
+         12345678901234567, -0.0, u"\u00e9\U0001f600"]
+
+
+class Backend:
+    """A JSON encoder: `dumps(obj)` returns bytes.
+
+    `identical` is whether its output is byte-identical to json.dumps
+    with default arguments (other backends omit whitespace, for example).
+    """
+
+    def __init__(self, name, dumps, identical=False):
+        self.name = name
+        self.dumps = dumps
+        self.identical = identical
+
+
+def round_trips(dumps):
+    """Whether dumps writes each PROBE value so that it reads back as is."""
+    try:
+        return all(repr(json.loads(dumps(value).decode("utf-8"))) ==
+                   repr(value) for value in PROBE)
+    except (TypeError, ValueError, OverflowError):
+        return False
+
+
+def register(backend):
+    """Make a backend available by name, unless it loses data."""
+    if round_trips(backend.dumps):
+        BACKENDS[backend.name] = backend
+
+
+def get(name):
+    """Look up a backend by name."""
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError("unknown serializer %s (available: %s)" %
+                         (name, ", ".join(sorted(BACKENDS))))
+
+
+def _json_dumps(obj):
+    """Serialise with the standard library, exactly as json.dumps does."""
+    text = json.dumps(obj)
+    return text if isinstance(text, bytes) else text.encode("utf-8")
+
+
+def _with_fallback(dumps):
+    """Fall back to the standard library for values a backend rejects.
+
+    (For example, orjson refuses non-string keys and very large integers.)
+    """
+    def fallback_dumps(obj):
+        """Serialise obj, with the standard library if need be."""
+        try:
+            return dumps(obj)
+        except (TypeError, ValueError, OverflowError):
+            return _json_dumps(obj)
+    return fallback_dumps
+
+
+register(Backend("json", _json_dumps, identical=True))
+
+
+# Types which can hold no float, skipped quickly by _non_finite.
+_SCALARS = frozenset([type(u""), type(b""), int, bool, type(None)])
+
+_INFINITIES = (float("inf"), float("-inf"))
+
+
+def _non_finite(obj):
+    """Whether obj holds a float NaN or infinity, at any depth."""
+    pending = [obj]
+    while pending:
+        value = pending.pop()
+        kind = type(value)
+        if kind in _SCALARS:
+            continue
+        if kind is dict or isinstance(value, dict):
+            pending.extend(value.values())
+        elif kind is list or isinstance(value, (list, tuple)):
+            pending.extend(value)
+        elif isinstance(value, float):
+            if value != value or value in _INFINITIES:
+                return True
+    return False
+
+
+if orjson is not None:
+    def _orjson_dumps(obj):
+        """Serialise with orjson, which writes NaN and infinity as null.
+
+        Such values are left to the standard library; they can only be
+        present where orjson wrote a null, so most objects need no scan.
+        """
+        data = orjson.dumps(obj)
+        if b"null" in data and _non_finite(obj):
+            return _json_dumps(obj)
+        return data
+
+    register(Backend("orjson", _with_fallback(_orjson_dumps)))
+
+# ujson 1.x rounds floats (and has no option not to).
+if ujson is not None and int(ujson.__version__.split(".")[0]) >= 2:
+    def _ujson_dumps(obj):
+        """Serialise with ujson, escaping like the standard library."""
+        text = ujson.dumps(obj, ensure_ascii=True,
+                           escape_forward_slashes=False)
+        return text if isinstance(text, bytes) else text.encode("utf-8")
+
+    register(Backend("ujson", _with_fallback(_ujson_dumps)))
+
+
+_CURRENT = {"backend": None}
+_CURRENT_LOCK = threading.Lock()
+
+
+def configure(name=DEFAULT):
+    """Select the process-wide backend."""
+    with _CURRENT_LOCK:
+        _CURRENT["backend"] = get(name)
+        return _CURRENT["backend"]
+
+
+def current():
+    """Return the process-wide backend, selecting one if needed."""
+    with _CURRENT_LOCK:
+        backend = _CURRENT["backend"]
+    return backend if backend is not None else configure()
+
+
+def dumps(obj):
+    """Serialise obj to JSON bytes with the process-wide backend."""
+    return current().dumps(obj)
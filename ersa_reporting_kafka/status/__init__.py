@@ -1 +1,74 @@
 #!/usr/bin/env python
+"""
+On-disk cache of kafka status metadata.
+"""
+
+# pylint: disable=import-error
+
+import time
+
+import arrow
+
+from ..cachefile import cache_path, load_json, save_json
+
+# Seconds for which a cached status is served without any requests.
+TTL = 60
+
+TIMESTAMPS = ["earliest_timestamp", "latest_timestamp"]
+
+
+def default_path(server):
+    """Per-server cache file under ~/.cache/ersa-kr."""
+    return cache_path("status", server)
+
+
+class StatusCache:
+    """Per-partition offsets and timestamps from the last status run."""
+
+    def __init__(self, path, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        self.updated = 0
+        self.topics = {}
+        self.load()
+
+    def load(self):
+        """Read the cache file; a missing or corrupt file is an empty cache."""
+        content = load_json(self.path)
+        if not content:
+            return
+
+        self.updated = content["updated"]
+        self.topics = {}
+        for topic, partitions in content["topics"].items():
+            for partition in partitions:
+                for key in TIMESTAMPS:
+                    if partition[key] is not None:
+                        partition[key] = arrow.get(partition[key])
+            self.topics[topic] = partitions
+
+    def fresh(self):
+        """Whether the cache is younger than its TTL."""
+        return time.time() - self.updated < self.ttl
+
+    def partitions(self):
+        """Cached partitions as topic -> partition id -> metadata."""
+        return dict((topic, dict((partition["partition"], partition)
+                                 for partition in partitions))
+                    for topic, partitions in self.topics.items())
+
+    def save(self, topics):
+        """Replace the cache with {topic: [partition metadata]}."""
+        content = {"updated": time.time(), "topics": {}}
+        for topic, partitions in topics.items():
+            content["topics"][topic] = []
+            for partition in partitions:
+                partition = dict(partition)
+                for key in TIMESTAMPS:
+                    if partition[key] is not None:
+                        partition[key] = partition[key].float_timestamp
+                content["topics"][topic].append(partition)
+
+        save_json(self.path, content)
+        self.updated = content["updated"]
+        self.topics = topics
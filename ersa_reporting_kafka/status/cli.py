@@ -11,6 +11,7 @@ import os
 from tabulate import tabulate
 
 from .. import REQUIRED_ENVIRONMENT_REPORTING, api
+from . import StatusCache, TTL, default_path
 
 COMMAND = "status"
 DESCRIPTION = "Show kafka status."
@@ -19,21 +20,68 @@ SCHEMA = COMMAND
 
 HEADING = ["Topic", "Window Size", "Earliest", "Latest"]
 
+THREADS = 8
+
 
 def setup(subparser):
     """Status CLI setup."""
-    pass
+    subparser.add_argument("--threads",
+                           type=int,
+                           default=THREADS,
+                           help="concurrent topic and partition fetches "
+                           "(default %i)" % THREADS)
+    subparser.add_argument("--fast",
+                           action="store_true",
+                           help="show offsets only; skip fetching "
+                           "earliest/latest message timestamps")
+    subparser.add_argument("--cache",
+                           help="status cache file "
+                           "(default ~/.cache/ersa-kr/status-SERVER.json)")
+    subparser.add_argument("--ttl",
+                           type=int,
+                           default=TTL,
+                           help="seconds to serve the cache without "
+                           "refreshing (default %i)" % TTL)
+    subparser.add_argument("--no-cache",
+                           action="store_true",
+                           help="neither read nor write the status cache")
+    subparser.add_argument("--sorted",
+                           action="store_true",
+                           help="print one table sorted by topic once "
+                           "every topic is fetched")
 
 
 def _printable(timestamp, offsets):
     """Generate a printable timestamp/offset string."""
+    timestamp_offset_string = "[%s]" % " ".join([str(o) for o in offsets])
+
     if not timestamp:
+        if any(o != "-" for o in offsets):
+            return timestamp_offset_string
         return "-"
 
-    timestamp_offset_string = "[%s]" % " ".join([str(o) for o in offsets])
     return "%s %s" % (timestamp.humanize(), timestamp_offset_string)
 
 
+def _record(topic, metadata):
+    """One table row for a topic."""
+    earliest = _printable(metadata["earliest_timestamp"],
+                          metadata["earliest_offsets"])
+    latest = _printable(metadata["latest_timestamp"],
+                        metadata["latest_offsets"])
+    return [topic, "{:,}".format(metadata["messages"]), earliest, latest]
+
+
+def _refresh(status, cache):
+    """Pass status through, saving it to the cache once complete."""
+    partitions = {}
+    for topic, metadata in status:
+        partitions[topic] = metadata["partitions"]
+        yield topic, metadata
+    if cache:
+        cache.save(partitions)
+
+
 def execute(args):
     """Status execution."""
     missing_environment = [
@@ -52,19 +100,36 @@ def execute(args):
         "https_verify": not args.insecure
     }
 
-    status = api.API(**api_config).list()
-
-    records = []
-
-    topics = sorted(list(status.keys()))
-
-    for topic in topics:
-        metadata = status[topic]
-        earliest = _printable(metadata["earliest_timestamp"],
-                              metadata["earliest_offsets"])
-        latest = _printable(metadata["latest_timestamp"],
-                            metadata["latest_offsets"])
-        records.append([topic, "{:,}".format(metadata["messages"]), earliest,
-                        latest])
-
-    print(tabulate(records, headers=HEADING))
+    kafka = api.API(**api_config)
+
+    # --fast results lack timestamps, so they are neither cached nor
+    # served from the cache.
+    cache = None
+    if not args.fast and not args.no_cache:
+        cache = StatusCache(args.cache if args.cache else
+                            default_path(api_config["server"]), args.ttl)
+
+    if cache and cache.fresh():
+        topics = sorted(cache.topics)
+        status = [(topic, api.summarise(cache.topics[topic]))
+                  for topic in topics]
+    else:
+        topics = kafka.topics()
+        status = _refresh(kafka.iter_list(
+            args.threads, timestamps=not args.fast, topic_names=topics,
+            cache=cache.partitions() if cache else None), cache)
+
+    if args.sorted:
+        records = [_record(topic, metadata) for topic, metadata in
+                   sorted(status)]
+        print(tabulate(records, headers=HEADING))
+        return
+
+    # Rows are printed as topics complete, so column widths are fixed up
+    # front from the topic names.
+    row = "%%-%is  %%15s  %%-45s  %%s" % max(
+        [len(HEADING[0])] + [len(topic) for topic in topics])
+    print(row % tuple(HEADING))
+    for topic, metadata in status:
+        print(row % tuple(_record(topic, metadata)))
+        sys.stdout.flush()
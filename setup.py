@@ -11,10 +11,12 @@ setup(
                       "python-keystoneclient", "python-cinderclient",
                       "python-novaclient", "python-ceilometerclient",
                       "backports.lzma", "tabulate"],
+    extras_require={"zstd": ["zstandard"], "lz4": ["lz4"]},
     packages=["ersa_reporting_kafka", "ersa_reporting_kafka.api",
               "ersa_reporting_kafka.archive",
               "ersa_reporting_kafka.hello_world", "ersa_reporting_kafka.nova",
               "ersa_reporting_kafka.cinder", "ersa_reporting_kafka.keystone",
               "ersa_reporting_kafka.ceilometer", "ersa_reporting_kafka.status",
-              "ersa_reporting_kafka.get"],
+              "ersa_reporting_kafka.get", "ersa_reporting_kafka.benchmark",
+              "ersa_reporting_kafka.lookup", "ersa_reporting_kafka.restore"],
     scripts=["bin/ersa-kr"])